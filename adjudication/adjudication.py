@@ -1,24 +1,32 @@
 """
 author: Bruce Atwood
 
-This script is used for merging two BRAT annotation .ann files (referent to same .txt file) into one single one.
+This script is used for merging two or more BRAT annotation .ann files (referent to same .txt file) into one single one.
 
 Entities that are wholly concordant are green as usual (the default in our BRAT .config file)
 Entities that diverge in their attributes only are marked as yellow
 Entities that differ in extent, including entities that exist in one .ann and not the other, are marked red. 
+With more than two annotators, see merge_many.
 """
 
 from pathlib import Path
 import click
 from dataclasses import dataclass, field, KW_ONLY
-from typing import Optional, Type, TypeVar
+from typing import Iterable, Iterator, Type, TypeVar
 from abc import ABC, abstractmethod
 import shutil
 import os
+import warnings
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from tqdm import tqdm
+
+import brat
 
 T = TypeVar('T')
 
 class Markable(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def mark(self, color):
@@ -28,14 +36,57 @@ class Markable(ABC):
     def base(self):
         raise NotImplementedError
 
+    @abstractmethod
+    def key(self):
+        """
+        hashable identity, a.key() == b.key() exactly when a.base() == b.base()
+        """
+        raise NotImplementedError
 
-@dataclass
+
+class Flag:
+    """
+    An attribute kept in a few bits of Entity.flags, as the index of its value in values (values[0] is the default).
+    Values are the ones "BRAT configuration/annotation.conf" allows, anything else is a ValueError.
+    """
+    def __init__(self, values: tuple, shift: int):
+        self.values = values
+        self.shift = shift
+        self.mask = (1 << (len(values) - 1).bit_length()) - 1
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        return self.values[entity.flags >> self.shift & self.mask]
+
+    def __set__(self, entity, value):
+        try:
+            i = self.values.index(value)
+        except ValueError:
+            raise ValueError(f"{value!r} isn't a {self.name} in annotation.conf, options: {self.values[1:] if self.values[0] is None else self.values}")
+        entity.flags = entity.flags & ~(self.mask << self.shift) | i << self.shift
+
+
+@dataclass(slots=True)
 class Entity(Markable):
+    """
+    Entities and relations are slotted, with int offsets, attributes packed into flags (see Flag), and their
+    identity key computed once: entity_type, text and indexes must not change after construction.
+    """
     _: KW_ONLY
     entity_type: str
     text: str
-    indexes: list[list[int]] # need multiple to account for sentence fragments
+    indexes: tuple[tuple[int, int], ...] # need multiple to account for sentence fragments
     marking: str = ""
+    flags: int = 0 # attributes, read and written through the Flag properties of each entity type
+    note: str = field(default="", compare=False) # written as an AnnotatorNotes line
+    _key: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._key = (self.entity_type, self.text, self.indexes)
 
     def mark(self: Type[T], color: str) -> T:
         self.marking = color
@@ -44,48 +95,63 @@ class Entity(Markable):
     def base(self: Type[T]) -> T:
         return self.__class__(entity_type=self.entity_type, text = self.text, indexes=self.indexes)
 
+    def key(self) -> tuple:
+        # entity_type also decides the class, so this is everything base() compares
+        return self._key
+
 
     def to_ann(self, tag_id: str):
-        spans = ";".join([" ".join(span) for span in self.indexes])
+        spans = ";".join([str(start) + " " + str(end) for start, end in self.indexes])
         append = "_" + self.marking if self.marking else ""
         return tag_id + "\t" + self.entity_type + append + " " + spans + "\t" + self.text + "\n"
 
 
 
 # ENTITY TYPES
-@dataclass
+@dataclass(slots=True)
 class Event(Entity):
     entity_type: str = "Event"
-    childhood_trauma: bool = False
-    factuality: str = "Factual" # options: Factual|Maybe|Unlikely
-    event_type: Optional[str] = None # options: Sexual|Physical|Emotional|Other
+    childhood_trauma = Flag((False, True), 0)
+    factuality = Flag(("Factual", "Maybe", "Unlikely"), 1)
+    event_type = Flag((None, "Sexual", "Physical", "Emotional", "Other"), 3)
 
-@dataclass
+@dataclass(slots=True)
 class Temporal_Frame(Entity):
     entity_type: str = "Temporal_Frame"
-    temporal_type: Optional[str] = None # options: Age|Period|Time-of-Life|Event|Date
+    temporal_type = Flag((None, "Age", "Period", "Time-of-Life", "Event", "Date"), 0)
 
-@dataclass
+@dataclass(slots=True)
 class Symptom(Entity):
     entity_type: str = "Symptom"
-    negation: bool = False
-    not_current_symptom: bool = False
+    negation = Flag((False, True), 0)
+    not_current_symptom = Flag((False, True), 1)
 
-@dataclass
+@dataclass(slots=True)
 class Perpetrator(Entity):
     entity_type: str = "Perpetrator"
-    perpetrator_type: Optional[str] = None # options: Family-Member|Colleague|Partner|Other-Known|Other-Unknown
+    perpetrator_type = Flag((None, "Family-Member", "Colleague", "Partner", "Other-Known", "Other-Unknown"), 0)
 
-@dataclass
+@dataclass(slots=True)
 class Substance(Entity):
     entity_type: str = "Substance"
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Relation(Markable):
     arg1: Entity
     arg2: Entity
     relation_type: str
     marking: str = ""
+    note: str = field(default="", compare=False) # written as an AnnotatorNotes line
+    _key: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # arguments only count by their identity, whatever their attributes and marking
+        self._key = (self.arg1.key(), self.arg2.key(), self.relation_type, self.marking)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key == other._key
 
     def mark(self, color):
         return self.__class__(self.arg1, self.arg2, self.relation_type, marking= color)
@@ -96,6 +162,13 @@ class Relation(Markable):
         """
         return self
 
+    def key(self) -> tuple:
+        # base() is the relation itself, marking included
+        return self._key
+
+
+ENTITY_CLASSES = {"Event": Event, "Temporal_Frame": Temporal_Frame, "Symptom": Symptom, "Perpetrator": Perpetrator, "Substance": Substance}
+
 
 @dataclass
 class Document:
@@ -109,23 +182,29 @@ def attribute2string(a: int, attribute_type: str ,tag_id: str, text: str="") ->
     return "A" + str(a) + "\t" + attribute_type +" " + tag_id + text + "\n"
 
 
+def note2string(n: int, tag_id: str, text: str) -> str:
+    return "#" + str(n) + "\tAnnotatorNotes " + tag_id + "\t" + text + "\n"
+
 
 
-def revert_ann(doc: Document) -> list:
+
+def revert_ann(doc: Document) -> Iterator[str]:
     """
-    Converts Document back to .ann file
+    Converts Document back to .ann file, yielding it line by line
+
+    Raises ValueError for a relation whose argument isn't one of the document's entities
     """
     e = 0 # entity count
     a = 0 # attribute count
     r = 0 # relation count
-    new_entity_mapping = []
-    file = []
+    n = 0 # note count
+    tag_ids = {} # entity key -> tag id, the last entity wins when several share a key
 
     for entity in doc.ann_entities:
 
         tag_id = "T"+ str(e)
-        new_entity_mapping.append((tag_id, entity)) # entities mutable so can't use dict
-        file.append(entity.to_ann(tag_id))
+        tag_ids[entity.key()] = tag_id
+        yield entity.to_ann(tag_id)
         e += 1 # increment entity count
 
         # Decompose Attributes
@@ -133,54 +212,59 @@ def revert_ann(doc: Document) -> list:
             case "Event":
                 # childhood_trauma
                 if entity.childhood_trauma:
-                    file.append(attribute2string(a, "Childhood_Trauma", tag_id))
+                    yield attribute2string(a, "Childhood_Trauma", tag_id)
                     a += 1 # increment attribute count (A1 -> A2 etc.)
                 # factuality
-                file.append(attribute2string(a, "Factuality",tag_id,entity.factuality))
+                yield attribute2string(a, "Factuality",tag_id,entity.factuality)
                 a+=1
                 # event_type
                 if entity.event_type:
-                    file.append(attribute2string(a,"Event_Type",tag_id,entity.event_type))
+                    yield attribute2string(a,"Event_Type",tag_id,entity.event_type)
                     a+=1
 
             case "Symptom":
                 # not_current_symptom
                 if entity.not_current_symptom:
-                    file.append(attribute2string(a,"Not_Current_Symptom", tag_id))
+                    yield attribute2string(a,"Not_Current_Symptom", tag_id)
                     a += 1
 
                 # negation
                 if entity.negation:
-                    file.append(attribute2string(a,"Negation", tag_id))
+                    yield attribute2string(a,"Negation", tag_id)
                     a += 1
 
             case "Perpetrator":
                 if entity.perpetrator_type:
-                    file.append(attribute2string(a,"Perpetrator_Type", tag_id, entity.perpetrator_type))
+                    yield attribute2string(a,"Perpetrator_Type", tag_id, entity.perpetrator_type)
                     a += 1
             case "Temporal_Frame":
                 if entity.temporal_type:
-                    file.append(attribute2string(a,"Temporal_Type",tag_id,entity.temporal_type))
+                    yield attribute2string(a,"Temporal_Type",tag_id,entity.temporal_type)
                     a += 1
 
+        if entity.note:
+            yield note2string(n, tag_id, entity.note)
+            n += 1
+
 
     for relation in doc.ann_relations:
         tag_id = "R" + str(r)
 
-        for entity_id, entity in new_entity_mapping:
-            if relation.arg1 == entity.base():
-                arg1_id = entity_id
-            if relation.arg2 == entity.base():
-                arg2_id = entity_id
+        try:
+            arg1_id = tag_ids[relation.arg1.key()]
+            arg2_id = tag_ids[relation.arg2.key()]
+        except KeyError:
+            raise ValueError(f"{relation.relation_type} relation between {relation.arg1.text!r} and {relation.arg2.text!r} has an argument that isn't an entity of the document")
 
         append = "_" + relation.marking if relation.marking else ""
 
-        file.append(tag_id + "\t" + relation.relation_type + append +" Arg1:" + arg1_id + " Arg2:" + arg2_id + "\n")
+        yield tag_id + "\t" + relation.relation_type + append +" Arg1:" + arg1_id + " Arg2:" + arg2_id + "\n"
+        if relation.note:
+            yield note2string(n, tag_id, relation.note)
+            n += 1
         r += 1 # increment relation count
 
 
-    return file
-
 
 
 def check_membership(objects: list[Markable], others: list[Markable], combined: list[Markable])-> list[Markable]:
@@ -193,25 +277,29 @@ def check_membership(objects: list[Markable], others: list[Markable], combined:
     if not member, marks red, then adds to combined.
     """
 
-    add = others != combined # calculate before combined is altered
+    add = others is not combined
+
+    # first of others for each identity, same one a scan through others would stop at
+    index = {}
+    for other in others:
+        assert isinstance(other, Markable)
+        index.setdefault(other.key(), other)
 
     for obj in objects:
         assert isinstance(obj, Markable)
-        shared = False
-
-        for other in others:
-            assert isinstance(other, Markable)
-
-            if obj.base() == other.base():
-                shared = True
-                if add: # 1 and 3 pass this test
-                    if obj == other: # 3 will always pass this test
-                        combined.append(obj)
-                    else:
-                        combined.append(obj.mark("yellow")) # keeps attrs of doc1 when only attrs differ. Could change this to either never keep attrs or keep the one with with more attrs, doesn't really matter
-                break
-        if not shared:
-            combined.append(obj.mark("red"))
+        other = index.get(obj.key())
+
+        if other is not None:
+            if add: # 1 and 3 pass this test
+                if obj == other: # 3 will always pass this test
+                    combined.append(obj)
+                else:
+                    combined.append(obj.mark("yellow")) # keeps attrs of doc1 when only attrs differ. Could change this to either never keep attrs or keep the one with with more attrs, doesn't really matter
+        else:
+            marked = obj.mark("red")
+            combined.append(marked)
+            if not add: # combined is others, so later objects are checked against this one too
+                index.setdefault(marked.key(), marked)
     return combined
 
 
@@ -236,101 +324,226 @@ def merge_docs(doc1: Document, doc2: Document) -> Document:
 
 
 
-def convert_ann(file: list) -> Document:
+def agreement_level(n_supporters: int, n_annotators: int) -> str:
+    if n_supporters == n_annotators:
+        return "unanimous"
+    if n_supporters * 2 > n_annotators:
+        return "majority"
+    if n_supporters == 1:
+        return "singleton"
+    return "minority"
+
+
+def most_common_variant(supporters: dict[str, Markable]) -> tuple[Markable, int]:
+    """
+    the version (attributes included) most annotators agree on, the earliest annotator's on ties,
+    and how many different versions there are
+    """
+    variants = [] # [item, count], in annotator order
+    for item in supporters.values():
+        for variant in variants:
+            if variant[0] == item:
+                variant[1] += 1
+                break
+        else:
+            variants.append([item, 1])
+    return max(variants, key=lambda variant: variant[1])[0], len(variants)
+
+
+def merge_many(docs: list[tuple[str, Document]]) -> tuple[Document, Counter]:
+    """
+    N-way version of merge_docs, docs are (annotator, document) pairs in order of precedence.
+
+    Every entity and relation goes into one index keyed on its identity (see Markable.key), recording
+    which annotators have it. Each appears once in the merged document, in order of first appearance,
+    with a note naming its annotators and agreement level (unanimous, majority, minority, singleton):
+        entities everyone has with the same attributes stay green
+        entities everyone has with different attributes, or a majority has, are yellow,
+            keeping the attributes most of them agree on
+        everything else is red (relations have no yellow, so they're red unless unanimous)
+    With two annotators this gives the same colors as merge_docs.
+
+    returns the merged document and the count of each agreement level
+    """
+    entity_index = {} # key -> {annotator: entity}
+    relation_index = {}
+    for annotator, doc in docs:
+        for entity in doc.ann_entities:
+            entity_index.setdefault(entity.key(), {}).setdefault(annotator, entity)
+        for relation in doc.ann_relations:
+            relation_index.setdefault(relation.key(), {}).setdefault(annotator, relation)
+
+    levels = Counter()
+    merged = Document([], [])
+    for supporters in entity_index.values():
+        level = agreement_level(len(supporters), len(docs))
+        entity, n_variants = most_common_variant(supporters)
+        if level == "unanimous":
+            color = "yellow" if n_variants > 1 else ""
+        else:
+            color = "yellow" if level == "majority" else "red"
+        entity = entity.mark(color)
+        entity.note = level + ": " + ", ".join(supporters)
+        merged.ann_entities.append(entity)
+        levels[level] += 1
+
+    for supporters in relation_index.values():
+        level = agreement_level(len(supporters), len(docs))
+        relation = next(iter(supporters.values())).mark("" if level == "unanimous" else "red")
+        relation.note = level + ": " + ", ".join(supporters)
+        merged.ann_relations.append(relation)
+        levels[level] += 1
+
+    return merged, levels
+
+
+MARKINGS = ("red", "yellow")
+
+
+def split_marking(tag_type: str) -> tuple[str, str]:
+    """
+    (type, marking) of an entity or relation type, which adjudicated files have the marking appended to (Event_red)
+    """
+    base, _, marking = tag_type.rpartition("_")
+    return (base, marking) if marking in MARKINGS else (tag_type, "")
+
+
+def convert_ann(file: Iterable[str]) -> Document:
     """
     Converts a brat annotation .ann file to a doc, which has two attributes:
         a dictionary of entitities, and a dictionary of relations.
 
-    ann_file: .ann file read in as list
+    ann_file: .ann file read in as list, or the open file itself (notes, events and equivalences are skipped)
+
+    Raises ValueError for an unknown entity type. An attribute the entity type can't have, or a value
+    annotation.conf doesn't list, is left out with a warning
     """
     doc = Document()
 
+    for record in brat.parse(file):
 
-    for line in file:
-
-        tokens = line.split()
+        if isinstance(record, brat.TextBound): # Entity
+            entity_type, marking = split_marking(record.type)
+            try:
+                entity_class = ENTITY_CLASSES[entity_type]
+            except KeyError:
+                raise ValueError(f"{record.id} has unknown entity type {record.type}")
+            doc.ann_entities[record.id] = entity_class(text = record.text, indexes=record.spans, marking=marking) # sentence fragments give several spans
 
-        if tokens[0][0] == "T": # Entity
+        elif isinstance(record, brat.Attribute): # Attribute
+            # If the line is an attribute, find the corresponding entity and update (marked by parent_id)
+            parent_id = record.target
+            try:
+                match record.name:
 
-            # Deal with sentence fragments
-            this_id, rest, text = line.strip().split("\t")
-            entity_type, *span = rest.split()
-            indexes = [tuple(tmp.split()) for tmp in " ".join(span).split(";")]     # self explanatory
+                    case "Perpetrator_Type":
+                        doc.ann_entities[parent_id].perpetrator_type = record.value
 
-            match entity_type:
+                    case "Temporal_Type":
+                        doc.ann_entities[parent_id].temporal_type = record.value
 
-                case "Symptom":
-                    entity = Symptom(text = text,indexes=indexes)
+                    case "Event_Type":
+                        doc.ann_entities[parent_id].event_type = record.value
 
-                case "Temporal_Frame":
-                    entity = Temporal_Frame(text = text,indexes=indexes)
+                    case "Not_Current_Symptom":
+                        doc.ann_entities[parent_id].not_current_symptom = True
 
-                case "Perpetrator":
-                    entity = Perpetrator(text = text,indexes=indexes)
+                    case "Childhood_Trauma":
+                        doc.ann_entities[parent_id].childhood_trauma = True
 
-                case "Event":
-                    entity = Event(text = text,indexes=indexes)
+                    case "Negation":
+                        try:
+                            doc.ann_entities[parent_id].negation = True
+                        except KeyError:
+                            pass
+                    case "Factuality":
+                        doc.ann_entities[parent_id].factuality = record.value
+            except AttributeError: # the entity type doesn't have it
+                warnings.warn(f"{record.id}: {type(doc.ann_entities[parent_id]).__name__} {parent_id} can't have {record.name}, left out")
+            except ValueError as e: # a value annotation.conf doesn't list
+                warnings.warn(f"{record.id}: {e}, left out")
 
-                case "Substance":
-                    entity = Substance(text = text,indexes=indexes)
+        elif isinstance(record, brat.Relation): # Relation
+            relation_type, marking = split_marking(record.type)
+            doc.ann_relations.append(Relation(doc.ann_entities[record.arg1], doc.ann_entities[record.arg2], relation_type, marking=marking))
 
-            doc.ann_entities[this_id] = entity
 
+    doc.ann_entities = list(doc.ann_entities.values())
 
+    return doc
 
-        elif tokens[0][0] == "A": # Attribute
-            # If the line is an attribute, find the corresponding entity and update (marked by parent_id)
-            parent_id = tokens[2]
 
-            match tokens[1]:
+def read_ann(path: Path) -> Document:
+    """
+    convert_ann of the file at path, with the path in its errors and warnings
+    """
+    with open(path, encoding="utf8") as f, warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        try:
+            doc = convert_ann(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+    for warning in caught:
+        warnings.warn(f"{path}: {warning.message}", stacklevel=2)
+    return doc
 
-                case "Perpetrator_Type":
-                    doc.ann_entities[parent_id].perpetrator_type = tokens[3]
 
-                case "Temporal_Type":
-                    doc.ann_entities[parent_id].temporal_type = tokens[3]
+def adjudicate(ann_file1: list, ann_file2: list) -> Iterator[str]:
 
-                case "Event_Type":
-                    doc.ann_entities[parent_id].event_type = tokens[3]
+    doc1 = convert_ann(ann_file1)
+    doc2 = convert_ann(ann_file2)
+    merged = merge_docs(doc1, doc2)
+    return revert_ann(merged)
 
-                case "Not_Current_Symptom":
-                    doc.ann_entities[parent_id].not_current_symptom = True
 
-                case "Childhood_Trauma":
-                    doc.ann_entities[parent_id].childhood_trauma = True
+def adjudicate_group(name: str, ann_paths: list[tuple[str, Path]], adjudicated: Path) -> tuple[str, Counter]:
+    """
+    Adjudicates the same file from several annotators ((annotator, path) pairs in order of precedence)
+    into adjudicated/name with merge_many, and copies the .txt over.
 
-                case "Negation":
-                    try:
-                        doc.ann_entities[parent_id].negation = True
-                    except KeyError:
-                        pass
-                case "Factuality":
-                    doc.ann_entities[parent_id].factuality = tokens[3]
+    returns name and the counts of red, yellow and unmarked (green) items and of each agreement level
+    """
+    docs = []
+    for annotator, path in ann_paths:
+        docs.append((annotator, read_ann(path)))
 
-        elif tokens[0][0] == "R": # Relation
+    merged, counts = merge_many(docs)
 
-            relation_type, arg1, arg2 = tokens[1::]
-            arg1_id = arg1[5:]
-            arg2_id = arg2[5:]
-            doc.ann_relations.append(Relation(doc.ann_entities[arg1_id].base(), doc.ann_entities[arg2_id].base(), relation_type))
+    with open(adjudicated/name, "w", encoding="utf8") as f:
+        f.writelines(revert_ann(merged))
 
+    for _, path in ann_paths:
+        if path.with_suffix(".txt").exists():
+            shutil.copy(path.with_suffix(".txt"), adjudicated)
+            break
 
-    doc.ann_entities = list(doc.ann_entities.values())
+    counts.update(item.marking or "green" for item in merged.ann_entities + merged.ann_relations)
+    return name, counts
 
-    return doc
 
+def adjudicate_star(task) -> tuple[str, Counter, str]:
+    """
+    adjudicate_group, with the error instead of counts for a group with a file convert_ann can't read
+    """
+    try:
+        return *adjudicate_group(*task), None
+    except ValueError as e:
+        return task[0], None, str(e)
 
-def adjudicate(ann_file1: list, ann_file2: list) -> list:
 
-    doc1 = convert_ann(ann_file1)
-    doc2 = convert_ann(ann_file2)
-    merged = merge_docs(doc1, doc2)
-    return revert_ann(merged)
+def find_annotators(annotators_path: Path) -> list[str]:
+    """
+    every annotator directory in annotators_path, alphabetically ("combined" isn't an annotator)
+    """
+    return sorted(path.name for path in annotators_path.iterdir() if path.is_dir() and path.name != "combined")
 
 
 @click.command()
 @click.argument('dir_path', type=click.Path(exists=True), required=True)
-def main(dir_path):
+@click.option('--annotators', default=None, help="comma separated annotator directories, in order of precedence "
+                                                  "(attributes of the first are kept when they differ), defaults to all of them alphabetically")
+@click.option('--processes', type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+def main(dir_path, annotators, processes):
     """
     dir_path is path to folder, with following structure (files created by this program in quotations):
 
@@ -358,7 +571,7 @@ def main(dir_path):
                 -"file1.ann"
                 -"file2.txt"
                 -"file2.txt"
-    list of subdirectories in annotators will need to be updated for project requirements
+    every subdirectory of annotators (but combined) is an annotator, unless --annotators says otherwise
 
     """
     dir_path = Path(dir_path)
@@ -367,37 +580,31 @@ def main(dir_path):
     if not adjudicated.exists():
         os.mkdir(adjudicated)
 
-    annotators = ["Mei","Ann","Phil"] # UPDATE THIS!
+    annotators = annotators.split(",") if annotators else find_annotators(dir_path/"annotators")
 
-    combined = []
+    # same file name from more than one annotator
+    groups = defaultdict(list)
     for annotator in annotators:
-        combined += (dir_path/"annotators"/annotator).glob("*.ann")
-
-    for index, file in enumerate(combined):
-
-
-        for i in range(index+1, len(combined)):
-            if combined[i].name == file.name:
-                output_path = adjudicated/file.name
-
-                with open(combined[i]) as f:
-                    one = f.readlines()
-
-                with open(file) as f:
-                    two = f.readlines()
-
-                output = adjudicate(two, one)
-
-                with open(output_path, "w", encoding="utf8") as f:
-                    for line in output:
-                        f.write(line)
-
-                try:
-                    shutil.copy(file.with_suffix(".txt"), adjudicated)
-                except:
-                    shutil.copy(combined[i].with_suffix(".txt"), adjudicated)
+        for file in (dir_path/"annotators"/annotator).glob("*.ann"):
+            groups[file.name].append((annotator, file))
+    tasks = [(name, paths, adjudicated) for name, paths in groups.items() if len(paths) > 1]
+
+    summary = {}
+    skipped = {}
+    with Pool(processes) as pool:
+        for name, counts, error in tqdm(pool.imap_unordered(adjudicate_star, tasks), total=len(tasks), desc="Adjudicating"):
+            if error is None:
+                summary[name] = counts
+            else:
+                skipped[name] = error
+
+    for name, counts in sorted(summary.items(), key=lambda item: (-item[1]["red"] - item[1]["yellow"], item[0])):
+        print(f"{name}\tred {counts['red']}\tyellow {counts['yellow']}\tgreen {counts['green']}\t"
+              f"unanimous {counts['unanimous']}\tmajority {counts['majority']}\tminority {counts['minority']}\tsingleton {counts['singleton']}")
+    print(f"{len(summary)} files adjudicated from {len(annotators)} annotators: " + ", ".join(f"{color} {n}" for color, n in sum(summary.values(), Counter()).items()))
+    for name, error in sorted(skipped.items()):
+        print(f"skipped {name}, {error} (unattributed_annotations.py reports every such problem)")
 
 
 if __name__ == '__main__':
     main()
-
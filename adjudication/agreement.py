@@ -0,0 +1,252 @@
+"""
+Inter-annotator agreement over a whole annotation directory (same layout as adjudication.py).
+
+For every pair of annotators that annotated the same file:
+    exact span F1: same entity type and spans
+    relation F1: same relation type between exactly matching entities
+    partial span F1: same entity type and overlapping spans
+    attribute agreement and Cohen's kappa, over the entities both annotated exactly the same
+    Cohen's kappa of entity types, over every extent either of them annotated
+        (an extent one of them left out counts as "None" for them), per label and overall
+
+Each file is reduced to a Counter of counts in parallel, and the Counters are summed, so the metrics
+come out the same as computing them over the corpus in one go.
+"""
+
+import bisect
+import json
+from collections import Counter, defaultdict
+from itertools import combinations
+from multiprocessing import Pool
+from pathlib import Path
+import click
+from tqdm import tqdm
+
+from adjudication import Document, find_annotators, read_ann
+
+ATTRIBUTES = ["factuality", "event_type", "perpetrator_type", "temporal_type", "negation"]
+
+
+def partial_matches(extents: list[tuple], others: list[tuple]) -> int:
+    """
+    number of extents (tuples of (start, end) spans) overlapping at least one of others
+    """
+    fragments = sorted(fragment for other in others for fragment in other)
+    starts = [start for start, _ in fragments]
+    max_end = [] # furthest end among the fragments up to each one
+    for _, end in fragments:
+        max_end.append(max(end, max_end[-1]) if max_end else end)
+
+    matched = 0
+    for extent in extents:
+        for start, end in extent:
+            i = bisect.bisect_left(starts, end) # fragments starting before this one ends
+            if i and max_end[i - 1] > start:
+                matched += 1
+                break
+    return matched
+
+
+def exact_counts(counts: Counter, kind: str, pair: tuple[str, str], keys_a: list[tuple], keys_b: list[tuple]) -> None:
+    """
+    keys are (label, key) pairs, adds how many each annotator has and how many they share, per label
+    """
+    keys_a, keys_b = Counter(keys_a), Counter(keys_b)
+    for (label, key), n in keys_a.items():
+        counts[kind, pair, label, "a"] += n
+        counts[kind, pair, label, "tp"] += min(n, keys_b[label, key])
+    for (label, key), n in keys_b.items():
+        counts[kind, pair, label, "b"] += n
+
+
+def keyed(doc: Document) -> tuple[list, list]:
+    """
+    (key, entity) for every entity and (relation type, key) for every relation of doc, keys are computed once per file
+    """
+    entities = [(entity.key(), entity) for entity in doc.ann_entities]
+    relations = [(relation.relation_type, relation.key()) for relation in doc.ann_relations]
+    return entities, relations
+
+
+def pair_counts(pair: tuple[str, str], doc_a: tuple[list, list], doc_b: tuple[list, list]) -> Counter:
+    """
+    agreement counts between two annotators of a file, docs as returned by keyed
+    """
+    (entities_a, relations_a), (entities_b, relations_b) = doc_a, doc_b
+    counts = Counter()
+
+    # exact spans, matched as multisets of identity keys (entity type, text, spans), and relations between
+    # exactly matching entities
+    exact_counts(counts, "exact", pair, [(key[0], key) for key, _ in entities_a], [(key[0], key) for key, _ in entities_b])
+    exact_counts(counts, "relation", pair, relations_a, relations_b)
+
+    # partial spans, per label
+    by_label_a, by_label_b = defaultdict(list), defaultdict(list)
+    for key, _ in entities_a:
+        by_label_a[key[0]].append(key[2])
+    for key, _ in entities_b:
+        by_label_b[key[0]].append(key[2])
+    for label in by_label_a.keys() | by_label_b.keys():
+        counts["partial", pair, label, "tp_a"] += partial_matches(by_label_a[label], by_label_b[label])
+        counts["partial", pair, label, "tp_b"] += partial_matches(by_label_b[label], by_label_a[label])
+
+    # attributes of exact matches, paired up in document order
+    unmatched_b = defaultdict(list)
+    for key, entity in entities_b:
+        unmatched_b[key].append(entity)
+    for key, entity in entities_a:
+        if unmatched_b[key]:
+            other = unmatched_b[key].pop(0)
+            for attribute in ATTRIBUTES:
+                if hasattr(entity, attribute):
+                    counts["attribute", pair, attribute, str(getattr(entity, attribute)), str(getattr(other, attribute))] += 1
+
+    # entity type of each extent either annotated
+    extents_a, extents_b = {}, {}
+    for key, _ in entities_a:
+        extents_a.setdefault(key[2], key[0])
+    for key, _ in entities_b:
+        extents_b.setdefault(key[2], key[0])
+    for extent in extents_a.keys() | extents_b.keys():
+        counts["extent", pair, extents_a.get(extent, "None"), extents_b.get(extent, "None")] += 1
+
+    return counts
+
+
+def file_counts(ann_paths: list[tuple[str, Path]]) -> Counter:
+    """
+    agreement counts for every pair of annotators of one file, ann_paths are (annotator, path) pairs
+    """
+    docs = []
+    for annotator, path in ann_paths:
+        docs.append((annotator, keyed(read_ann(path))))
+
+    counts = Counter()
+    for (a, doc_a), (b, doc_b) in combinations(docs, 2):
+        counts.update(pair_counts((a, b), doc_a, doc_b))
+    return counts
+
+
+def f1(tp_a: int, n_a: int, tp_b: int, n_b: int) -> float:
+    """
+    tp_a of n_a entities of a found in b, tp_b of n_b entities of b found in a
+    """
+    recall = tp_a / n_a if n_a else 0.0
+    precision = tp_b / n_b if n_b else 0.0
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def cohen_kappa(confusion: dict) -> float:
+    """
+    confusion: (category of a, category of b) -> count
+    """
+    total = sum(confusion.values())
+    if not total:
+        return float("nan")
+    rows, columns = Counter(), Counter()
+    for (x, y), n in confusion.items():
+        rows[x] += n
+        columns[y] += n
+    observed = sum(n for (x, y), n in confusion.items() if x == y) / total
+    expected = sum(rows[c] * columns[c] for c in rows) / total ** 2
+    return (observed - expected) / (1 - expected) if expected < 1 else 1.0
+
+
+def metrics(counts: Counter) -> dict:
+    """
+    turns summed counts into {pair: {metric: value}}, with an "all pairs" entry pooling every pair
+    """
+    grouped = defaultdict(Counter) # (pair, kind) -> counts for the rest of the key
+    for (kind, pair, *rest), n in counts.items():
+        for name in (" & ".join(pair), "all pairs"):
+            grouped[name, kind][tuple(rest)] += n
+
+    results = defaultdict(dict)
+    for (name, kind), group in grouped.items():
+        result = results[name]
+        if kind in ("exact", "relation"):
+            labels = {label for label, _ in group}
+            for label in sorted(labels) + ["all"]:
+                n_a = sum(n for (l, part), n in group.items() if part == "a" and label in (l, "all"))
+                n_b = sum(n for (l, part), n in group.items() if part == "b" and label in (l, "all"))
+                tp = sum(n for (l, part), n in group.items() if part == "tp" and label in (l, "all"))
+                result[f"{kind}_f1/{label}"] = f1(tp, n_a, tp, n_b)
+                result[f"{'n' if kind == 'exact' else 'n_relations'}/{label}"] = (n_a, n_b)
+        elif kind == "partial":
+            labels = {label for label, _ in group}
+            exact = grouped[name, "exact"]
+            for label in sorted(labels) + ["all"]:
+                n_a = sum(n for (l, part), n in exact.items() if part == "a" and label in (l, "all"))
+                n_b = sum(n for (l, part), n in exact.items() if part == "b" and label in (l, "all"))
+                tp_a = sum(n for (l, part), n in group.items() if part == "tp_a" and label in (l, "all"))
+                tp_b = sum(n for (l, part), n in group.items() if part == "tp_b" and label in (l, "all"))
+                result[f"partial_f1/{label}"] = f1(tp_a, n_a, tp_b, n_b)
+        elif kind == "attribute":
+            for attribute in ATTRIBUTES:
+                confusion = {(x, y): n for (a, x, y), n in group.items() if a == attribute}
+                if confusion:
+                    total = sum(confusion.values())
+                    result[f"attribute_agreement/{attribute}"] = sum(n for (x, y), n in confusion.items() if x == y) / total
+                    result[f"attribute_kappa/{attribute}"] = cohen_kappa(confusion)
+        elif kind == "extent":
+            result["type_kappa/all"] = cohen_kappa(group)
+            for label in sorted(({x for x, _ in group} | {y for _, y in group}) - {"None"}):
+                binary = Counter()
+                for (x, y), n in group.items():
+                    binary[x == label, y == label] += n
+                result[f"type_kappa/{label}"] = cohen_kappa(binary)
+    return results
+
+
+def file_counts_star(task) -> tuple[Counter, str]:
+    """
+    file_counts, with the error instead for a file read_ann can't read, which is left out
+    """
+    try:
+        return file_counts(task), None
+    except ValueError as e:
+        return Counter(), str(e)
+
+
+@click.command()
+@click.argument('dir_path', type=click.Path(exists=True), required=True)
+@click.option('--annotators', default=None, help="comma separated annotator directories, defaults to all of them")
+@click.option('--processes', type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+@click.option('--output', type=click.Path(), default=None, help="also write the metrics to this .json file")
+def main(dir_path, annotators, processes, output):
+    """
+    dir_path is the same folder adjudication.py takes, with a directory per annotator in dir_path/annotators
+    """
+    dir_path = Path(dir_path)
+    annotators = annotators.split(",") if annotators else find_annotators(dir_path/"annotators")
+
+    groups = defaultdict(list)
+    for annotator in annotators:
+        for file in (dir_path/"annotators"/annotator).glob("*.ann"):
+            groups[file.name].append((annotator, file))
+    tasks = [paths for paths in groups.values() if len(paths) > 1]
+
+    counts = Counter()
+    skipped = []
+    with Pool(processes) as pool:
+        for file_count, error in tqdm(pool.imap_unordered(file_counts_star, tasks, chunksize=16), total=len(tasks), desc="Counting"):
+            counts.update(file_count) # not +=, which drops zero counts
+            if error is not None:
+                skipped.append(error)
+
+    results = metrics(counts)
+    for name in sorted(results, key=lambda name: (name == "all pairs", name)):
+        print(name)
+        for metric, value in sorted(results[name].items()):
+            print(f"    {metric}\t{value if isinstance(value, tuple) else round(value, 3)}")
+    print(f"{len(tasks)} files annotated by more than one of {len(annotators)} annotators")
+    for error in sorted(skipped):
+        print(f"skipped {error} (unattributed_annotations.py reports every such problem)")
+
+    if output:
+        with open(output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
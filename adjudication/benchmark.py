@@ -0,0 +1,297 @@
+"""
+Benchmarks for the adjudication tools on synthetic .ann files, checks the fast paths give the
+same output as the code they replaced
+
+python benchmark.py
+"""
+
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field, KW_ONLY
+from pathlib import Path
+from typing import Optional
+
+import adjudication
+import brat
+from adjudication import Markable, Document, Relation, ENTITY_CLASSES, convert_ann, revert_ann, merge_docs
+
+ENTITY_TYPES = ["Event", "Symptom", "Perpetrator", "Temporal_Frame", "Substance"]
+WORDS = ["kicked", "father", "age 12", "hopeless", "alcohol", "uncle", "hit", "childhood", "insomnia", "partner"]
+
+
+def synthetic_ann(n_entities: int, seed: int = 0) -> list[str]:
+    """
+    .ann lines for a long note, with attributes, relations and some discontinuous spans
+    """
+    rng = random.Random(seed)
+    lines = []
+    a = 0
+    for t in range(n_entities):
+        entity_type = rng.choice(ENTITY_TYPES)
+        start = rng.randrange(0, 20 * n_entities)
+        text = rng.choice(WORDS)
+        if rng.random() < 0.1:
+            spans = f"{start} {start + 3};{start + 10} {start + 10 + len(text) - 3}"
+        else:
+            spans = f"{start} {start + len(text)}"
+        lines.append(f"T{t}\t{entity_type} {spans}\t{text}\n")
+        if entity_type == "Event":
+            lines.append(f"A{a}\tFactuality T{t} {rng.choice(['Factual', 'Maybe', 'Unlikely'])}\n")
+            a += 1
+            if rng.random() < 0.5:
+                lines.append(f"A{a}\tEvent_Type T{t} {rng.choice(['Sexual', 'Physical', 'Emotional', 'Other'])}\n")
+                a += 1
+        elif entity_type == "Symptom" and rng.random() < 0.3:
+            lines.append(f"A{a}\tNegation T{t}\n")
+            a += 1
+    for r in range(n_entities // 3):
+        lines.append(f"R{r}\t{rng.choice(['Perpetrated_By', 'Grounded_To', 'Sub-Event'])} Arg1:T{rng.randrange(n_entities)} Arg2:T{rng.randrange(n_entities)}\n")
+    return lines
+
+
+def second_annotator(lines: list[str], seed: int = 1) -> list[str]:
+    """
+    the same note as annotated by someone else: most lines kept, some dropped, some attributes changed
+    """
+    rng = random.Random(seed)
+    kept = []
+    for line in lines:
+        if line[0] == "A" and rng.random() < 0.2:
+            continue
+        if line[0] == "T" and rng.random() < 0.05:
+            tag_id, rest, _ = line.split("\t")
+            line = f"{tag_id}\t{rest}\tother\n"
+        kept.append(line)
+    return kept
+
+
+def check_membership_scan(objects: list[Markable], others: list[Markable], combined: list[Markable]) -> list[Markable]:
+    """
+    check_membership as it used to be, comparing every object against every other
+    """
+    add = others != combined
+    for obj in objects:
+        shared = False
+        for other in others:
+            if obj.base() == other.base():
+                shared = True
+                if add:
+                    if obj == other:
+                        combined.append(obj)
+                    else:
+                        combined.append(obj.mark("yellow"))
+                break
+        if not shared:
+            combined.append(obj.mark("red"))
+    return combined
+
+
+def timed_merge(one: list[str], two: list[str], check_membership) -> tuple[list[str], float]:
+    original = adjudication.check_membership
+    adjudication.check_membership = check_membership
+    try:
+        doc1, doc2 = convert_ann(one), convert_ann(two)
+        start = time.perf_counter()
+        merged = merge_docs(doc1, doc2)
+        elapsed = time.perf_counter() - start
+    finally:
+        adjudication.check_membership = original
+    return list(revert_ann(merged)), elapsed
+
+
+def bench_check_membership(n_entities: int = 1500, n_pairs: int = 3) -> None:
+    old_time = new_time = 0
+    for seed in range(n_pairs):
+        one = synthetic_ann(n_entities, seed)
+        two = second_annotator(one, seed)
+        old, elapsed = timed_merge(one, two, check_membership_scan)
+        old_time += elapsed
+        new, elapsed = timed_merge(one, two, adjudication.check_membership)
+        new_time += elapsed
+        assert old == new
+    print(f"merge_docs ({n_pairs} pairs, {n_entities} entities): scan {old_time:.2f}s, index {new_time:.4f}s, {old_time / new_time:.0f}x")
+
+
+def bench_agreement(n_files: int = 200, n_entities: int = 200) -> None:
+    from agreement import file_counts, metrics
+    with tempfile.TemporaryDirectory() as tmp:
+        tasks = []
+        for seed in range(n_files):
+            one = synthetic_ann(n_entities, seed)
+            paths = [(annotator, Path(tmp) / f"{annotator}-{seed}.ann") for annotator in ("one", "two")]
+            paths[0][1].write_text("".join(one))
+            paths[1][1].write_text("".join(second_annotator(one, seed)))
+            tasks.append(paths)
+
+        start = time.perf_counter()
+        counts = sum((file_counts(paths) for paths in tasks), start=Counter())
+        results = metrics(counts)
+        elapsed = time.perf_counter() - start
+    print(f"agreement ({n_files} file pairs, {n_entities} entities): {n_files / elapsed:.0f} files/s on one process, "
+          f"exact F1 {results['all pairs']['exact_f1/all']:.3f}")
+
+
+def convert_ann_split(file: list) -> Document:
+    """
+    convert_ann as it used to be, splitting every line itself (attributes of the five types only)
+    """
+    doc = Document()
+    for line in file:
+        tokens = line.split()
+        if tokens[0][0] == "T":
+            this_id, rest, text = line.strip().split("\t")
+            entity_type, *span = rest.split()
+            indexes = tuple(tuple(tmp.split()) for tmp in " ".join(span).split(";")) # kept as strings, to_ann writes them the same
+            doc.ann_entities[this_id] = ENTITY_CLASSES[entity_type](text=text, indexes=indexes)
+        elif tokens[0][0] == "A":
+            entity = doc.ann_entities[tokens[2]]
+            match tokens[1]:
+                case "Event_Type":
+                    entity.event_type = tokens[3]
+                case "Negation":
+                    entity.negation = True
+                case "Factuality":
+                    entity.factuality = tokens[3]
+        elif tokens[0][0] == "R":
+            relation_type, arg1, arg2 = tokens[1::]
+            doc.ann_relations.append(Relation(doc.ann_entities[arg1[5:]].base(), doc.ann_entities[arg2[5:]].base(), relation_type))
+    doc.ann_entities = list(doc.ann_entities.values())
+    return doc
+
+
+def with_full_grammar(lines: list[str]) -> list[str]:
+    """
+    lines plus the notes, events, equivalences and normalizations convert_ann skips
+    """
+    entity_ids = [line.split("\t")[0] for line in lines if line[0] == "T"]
+    extra = [f"#{i}\tAnnotatorNotes {tag_id}\tchecked with the team" for i, tag_id in enumerate(entity_ids[::10])]
+    extra += [f"E{i}\tEvent:{tag_id} Agent:{entity_ids[0]}" for i, tag_id in enumerate(entity_ids[::7])]
+    extra += [f"*\tEquiv {' '.join(entity_ids[i:i + 3])}" for i in range(0, len(entity_ids) - 3, 50)]
+    extra += [f"N{i}\tReference {tag_id} UMLS:C0000{i}\tconcept" for i, tag_id in enumerate(entity_ids[::20])]
+    return lines + [line + "\n" for line in extra]
+
+
+def bench_parse(n_files: int = 100, n_entities: int = 1000) -> None:
+    files = [synthetic_ann(n_entities, seed) for seed in range(n_files)]
+    n_lines = sum(len(lines) for lines in files)
+
+    # timed without keeping the documents, so one side doesn't pay for collecting the other's garbage
+    start = time.perf_counter()
+    for lines in files:
+        convert_ann_split(lines)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for lines in files:
+        convert_ann(lines)
+    new_time = time.perf_counter() - start
+    assert all(list(revert_ann(convert_ann_split(lines))) == list(revert_ann(convert_ann(lines))) for lines in files)
+
+    full = [with_full_grammar(lines) for lines in files]
+    n_full = sum(len(lines) for lines in full)
+    start = time.perf_counter()
+    n_records = sum(1 for lines in full for _ in brat.parse(lines))
+    parse_time = time.perf_counter() - start
+    assert n_records == n_full
+
+    print(f"convert_ann ({n_files} files, {n_lines} lines): split per line {n_lines / old_time:,.0f} lines/s, "
+          f"brat.parse {n_lines / new_time:,.0f} lines/s; brat.parse alone, full grammar: {n_full / parse_time:,.0f} lines/s")
+
+
+@dataclass
+class EntityDataclass:
+    """
+    Entity as it used to be, a plain dataclass with string offsets and one field per attribute
+    """
+    _: KW_ONLY
+    entity_type: str
+    text: str
+    indexes: list[list[int]]
+    marking: str = ""
+    note: str = field(default="", compare=False)
+
+    def base(self):
+        return self.__class__(entity_type=self.entity_type, text=self.text, indexes=self.indexes)
+
+    def key(self) -> tuple:
+        return self.entity_type, self.text, tuple(tuple(int(i) for i in span) for span in self.indexes)
+
+@dataclass
+class EventDataclass(EntityDataclass):
+    entity_type: str = "Event"
+    childhood_trauma: bool = False
+    factuality: str = "Factual"
+    event_type: Optional[str] = None
+
+
+def bench_model(n_entities: int = 100_000) -> None:
+    lines = [line for line in synthetic_ann(n_entities) if line[0] == "T"]
+    fields = [(line.split("\t")[1].split(" ", 1)[1], line.split("\t")[2].rstrip()) for line in lines] # offsets, text
+
+    def build_old():
+        return [EventDataclass(text=text, indexes=[tuple(span.split()) for span in offsets.split(";")], factuality="Maybe")
+                for offsets, text in fields]
+
+    def build_new():
+        entities = []
+        for offsets, text in fields:
+            entity = adjudication.Event(text=text, indexes=brat.parse_spans(offsets))
+            entity.factuality = "Maybe"
+            entities.append(entity)
+        return entities
+
+    for name, build in [("dataclass", build_old), ("slotted", build_new)]:
+        tracemalloc.start()
+        entities = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        copies = build() # equal objects, as the same entity from another annotator
+        start = time.perf_counter()
+        identical = sum(a.base() == b.base() for a, b in zip(entities, copies))
+        base_time = time.perf_counter() - start
+        start = time.perf_counter()
+        assert sum(a.key() == b.key() for a, b in zip(entities, copies)) == identical
+        key_time = time.perf_counter() - start
+        start = time.perf_counter()
+        assert sum(a == b for a, b in zip(entities, copies)) == identical
+        eq_time = time.perf_counter() - start
+
+        print(f"{name} entities ({n_entities}): {size / n_entities:.0f} bytes each, "
+              f"base() == base() {base_time / n_entities * 1e9:.0f} ns, key() == key() {key_time / n_entities * 1e9:.0f} ns, "
+              f"== {eq_time / n_entities * 1e9:.0f} ns")
+
+
+def bench_offsets(n_files: int = 2000, n_entities: int = 50) -> None:
+    """
+    offsets.verify_file over notes of about 6k characters, a quarter of them CRLF copies of what was annotated
+    """
+    from offsets import verify_file
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(n_files):
+            text = "\n".join(" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(80))
+            lines = []
+            for t in range(n_entities):
+                start = text.index(" ", rng.randrange(len(text) - 20)) + 1
+                end = min(text.index(" ", start), text.find("\n", start) % len(text))
+                lines.append(f"T{t}\tEvent {start} {end}\t{text[start:end]}\n")
+            (Path(tmp) / f"{i}.txt").write_bytes((text.replace("\n", "\r\n") if i % 4 == 0 else text).encode())
+            (Path(tmp) / f"{i}.ann").write_text("".join(lines))
+
+        start = time.perf_counter()
+        problems = sum(len(verify_file((path, False, 64))[1]) for path in Path(tmp).glob("*.ann"))
+        elapsed = time.perf_counter() - start
+    print(f"offsets ({n_files} files, {n_files * n_entities} entities): {n_files / elapsed:,.0f} files/s, "
+          f"{n_files * n_entities / elapsed:,.0f} entities/s on one process, {problems} shifted entities found")
+
+
+if __name__ == "__main__":
+    bench_check_membership()
+    bench_agreement()
+    bench_parse()
+    bench_model()
+    bench_offsets()
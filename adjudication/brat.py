@@ -0,0 +1,149 @@
+"""
+Streaming parser for BRAT standoff .ann files, shared by adjudication.py, unattributed_annotations.py and agreement.py
+
+Reads line by line (a list of lines or an open file both work), and yields one small slotted record per
+annotation, in file order. Entity types, attribute names and values, and relation/event types are interned,
+since a corpus only has a handful of them. Offsets are ints.
+
+Covers the whole line grammar:
+    T1	Type start end[;start end...]	text        TextBound
+    E1	Type:T1 Role:T2 Role2:E3                 Event
+    R1	Type Arg1:T1 Arg2:T2                     Relation
+    *	Equiv T1 T2 T3                           Equiv
+    A1	Name T1 [Value] (and legacy M1 lines)    Attribute
+    N1	Reference T1 Db:id	text                Normalization
+    #1	AnnotatorNotes T1	text                Note
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from sys import intern
+from typing import Iterable, Iterator, Union
+
+
+@dataclass(slots=True)
+class TextBound:
+    id: str
+    type: str
+    spans: tuple[tuple[int, int], ...] # more than one for discontinuous entities
+    text: str
+
+@dataclass(slots=True)
+class Event:
+    id: str
+    type: str
+    trigger: str
+    args: tuple[tuple[str, str], ...] # (role, id)
+
+@dataclass(slots=True)
+class Relation:
+    id: str
+    type: str
+    arg1: str
+    arg2: str
+
+@dataclass(slots=True)
+class Equiv:
+    type: str
+    ids: tuple[str, ...]
+
+@dataclass(slots=True)
+class Attribute:
+    id: str
+    name: str
+    target: str
+    value: str = "" # empty for binary attributes
+
+@dataclass(slots=True)
+class Normalization:
+    id: str
+    type: str
+    target: str
+    reference: str
+    text: str = ""
+
+@dataclass(slots=True)
+class Note:
+    id: str
+    type: str
+    target: str
+    text: str = ""
+
+Record = Union[TextBound, Event, Relation, Equiv, Attribute, Normalization, Note]
+
+
+def parse_spans(offsets: str) -> tuple[tuple[int, int], ...]:
+    if ";" not in offsets: # the usual, contiguous case
+        start, end = offsets.split()
+        return ((int(start), int(end)),)
+    spans = []
+    for span in offsets.split(";"):
+        start, end = span.split()
+        spans.append((int(start), int(end)))
+    return tuple(spans)
+
+
+def parse_line(line: str) -> Record:
+    """
+    Raises ValueError for a line that isn't BRAT standoff
+    """
+    tag_id, _, rest = line.partition("\t")
+    match line[0]:
+        case "T":
+            annotation, _, text = rest.partition("\t")
+            entity_type, _, offsets = annotation.partition(" ")
+            return TextBound(tag_id, intern(entity_type), parse_spans(offsets), text)
+
+        case "A" | "M":
+            name, target, *value = rest.split()
+            return Attribute(tag_id, intern(name), target, intern(value[0]) if value else "")
+
+        case "R":
+            relation_type, arg1, arg2 = rest.split()
+            return Relation(tag_id, intern(relation_type), arg1.partition(":")[2], arg2.partition(":")[2])
+
+        case "E":
+            trigger, *args = rest.split()
+            event_type, _, trigger_id = trigger.partition(":")
+            return Event(tag_id, intern(event_type), trigger_id,
+                         tuple((intern(role), arg_id) for role, _, arg_id in (arg.partition(":") for arg in args)))
+
+        case "*":
+            equiv_type, *ids = rest.split()
+            return Equiv(intern(equiv_type), tuple(ids))
+
+        case "N":
+            annotation, _, text = rest.partition("\t")
+            normalization_type, target, reference = annotation.split()
+            return Normalization(tag_id, intern(normalization_type), target, reference, text)
+
+        case "#":
+            annotation, _, text = rest.partition("\t")
+            note_type, _, target = annotation.partition(" ")
+            return Note(tag_id, intern(note_type), target, text)
+
+    raise ValueError(f"not a BRAT annotation line: {line!r}")
+
+
+def parse(lines: Iterable[str]) -> Iterator[Record]:
+    """
+    Records of an .ann file, lines can be a list or an open file, blank lines are skipped
+
+    Raises ValueError (with the line number) for a line that isn't BRAT standoff
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        try:
+            yield parse_line(line)
+        except ValueError as e:
+            raise ValueError(f"line {number}: {e}") from None
+
+
+def read(path: Path) -> Iterator[Record]:
+    """
+    Records of the .ann file at path, read incrementally
+    """
+    with open(path, encoding="utf8") as f:
+        yield from parse(f)
@@ -0,0 +1,255 @@
+"""
+Checks that the offsets of every entity in .ann files point at its text in the .txt next to it, and repairs
+offsets that were shifted, by annotating a CRLF copy of an LF note (or the other way round) or a small drift.
+
+Each .txt is memory mapped; ASCII notes (almost all of them) are compared byte for byte without decoding.
+Discontinuous entities are checked fragment by fragment, their text being the fragments joined by a space.
+
+python offsets.py EHR                 reports problems, exits with 1 if there are any (use as a pre-commit gate)
+python offsets.py EHR --repair        rewrites the offsets that can be repaired, reports the rest
+python offsets.py a.ann b.ann ...     only those files
+"""
+
+import bisect
+import mmap
+import os
+import re
+import sys
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Optional
+import click
+
+import brat
+
+NON_ASCII = re.compile(rb"[\x80-\xff]")
+
+
+class Text:
+    """
+    A note's text, sliced by character offset. buffer is the raw bytes (or a memory map of them)
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if NON_ASCII.search(buffer) is None:
+            self.chars = None # bytes and characters line up
+            self.length = len(buffer)
+        else:
+            self.chars = bytes(buffer).decode("utf8")
+            self.length = len(self.chars)
+        self._newlines = None
+
+    def __len__(self):
+        return self.length
+
+    def matches(self, start: int, end: int, fragment: str) -> bool:
+        if self.chars is None:
+            return self.buffer[start:end] == fragment.encode("utf8")
+        return self.chars[start:end] == fragment
+
+    def slice(self, start: int, end: int) -> str:
+        if self.chars is None:
+            return self.buffer[start:end].decode("ascii")
+        return self.chars[start:end]
+
+    def find(self, fragment: str, start: int, end: int) -> list[int]:
+        """
+        offsets of every occurrence of fragment starting between start and end
+        """
+        if self.chars is None:
+            needle, haystack = fragment.encode("utf8"), self.buffer
+        else:
+            needle, haystack = fragment, self.chars
+        found = []
+        i = haystack.find(needle, max(start, 0), end + len(needle))
+        while i != -1:
+            found.append(i)
+            i = haystack.find(needle, i + 1, end + len(needle))
+        return found
+
+    def newlines(self) -> tuple[list[int], bool]:
+        """
+        character offsets of the line breaks (of the \r of each \r\n), and whether they're CRLF
+        """
+        if self._newlines is None:
+            if self.chars is None:
+                crlf = self.buffer.find(b"\r\n") != -1
+                pattern = rb"\r\n" if crlf else rb"\n"
+                positions = [m.start() for m in re.finditer(pattern, self.buffer)]
+            else:
+                crlf = "\r\n" in self.chars
+                positions = [m.start() for m in re.finditer("\r\n" if crlf else "\n", self.chars)]
+            self._newlines = positions, crlf
+        return self._newlines
+
+
+def open_text(txt_path: Path) -> Text:
+    """
+    memory maps the file (the map stays open for as long as the Text is around)
+    """
+    with open(txt_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return Text(b"")
+        return Text(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def fragments(entity: brat.TextBound) -> Optional[list[str]]:
+    """
+    the entity's text cut into one piece per span, None when the lengths don't add up
+    """
+    pieces = []
+    i = 0
+    for start, end in entity.spans:
+        pieces.append(entity.text[i:i + end - start])
+        i += end - start + 1 # the space BRAT puts between fragments
+    if i - 1 != len(entity.text):
+        return None
+    return pieces
+
+
+def shifted(spans, text: Text) -> Optional[tuple[str, tuple]]:
+    """
+    spans moved onto the text the annotation was probably made on a converted copy of:
+        "crlf", offsets counted with LF line breaks in a CRLF note
+        "lf", offsets counted with CRLF line breaks in an LF note
+    """
+    positions, crlf = text.newlines()
+    if not positions:
+        return None
+    if crlf:
+        lf_positions = [p - k for k, p in enumerate(positions)] # where the breaks were without the \r
+        return "crlf", tuple((start + bisect.bisect_left(lf_positions, start), end + bisect.bisect_left(lf_positions, end))
+                             for start, end in spans)
+    crlf_positions = [p + k for k, p in enumerate(positions)] # where the \r were in the CRLF copy
+    return "lf", tuple((start - bisect.bisect_left(crlf_positions, start), end - bisect.bisect_left(crlf_positions, end))
+                       for start, end in spans)
+
+
+def check(entity: brat.TextBound, text: Text, window: int = 64) -> tuple[str, Optional[tuple]]:
+    """
+    status of the entity's offsets and, when they can be repaired, the repaired spans:
+        ("ok", None)
+        ("length", None), the text doesn't have the length the spans say
+        ("crlf" | "lf" | "shift", spans), repairable, see shifted, "shift" being the nearest place within window
+            characters where all fragments match with the same offset
+        ("out_of_range", None) or ("mismatch", None), not repairable
+    """
+    pieces = fragments(entity)
+    if pieces is None:
+        return "length", None
+
+    def fits(spans) -> bool:
+        return all(0 <= start <= end <= len(text) and text.matches(start, end, piece) for (start, end), piece in zip(spans, pieces))
+
+    if fits(entity.spans):
+        return "ok", None
+
+    moved = shifted(entity.spans, text)
+    if moved and fits(moved[1]):
+        return moved
+
+    start = entity.spans[0][0]
+    for candidate in sorted(text.find(pieces[0], start - window, start + window), key=lambda i: abs(i - start)):
+        spans = tuple((s + candidate - start, e + candidate - start) for s, e in entity.spans)
+        if fits(spans):
+            return "shift", spans
+
+    if any(start < 0 or start > end or end > len(text) for start, end in entity.spans):
+        return "out_of_range", None
+    return "mismatch", None
+
+
+def entity_line(entity: brat.TextBound, spans) -> str:
+    return entity.id + "\t" + entity.type + " " + ";".join(f"{start} {end}" for start, end in spans) + "\t" + entity.text + "\n"
+
+
+def verify_file(task: tuple[Path, bool, int]) -> tuple[Path, list[tuple[str, str, str]]]:
+    """
+    task is (.ann path, whether to repair, window)
+
+    returns the path and its problems as (tag id, status, detail), repaired ones included
+    """
+    ann_path, repair, window = task
+    txt_path = ann_path.with_suffix(".txt")
+    if not txt_path.exists():
+        return ann_path, [("", "missing_txt", str(txt_path))]
+
+    with open(ann_path, encoding="utf8", newline="") as f:
+        lines = f.readlines()
+    try:
+        records = list(brat.parse(lines))
+    except ValueError as e:
+        return ann_path, [("", "parse_error", str(e))]
+
+    text = open_text(txt_path)
+    problems = []
+    repaired = {} # tag id -> replacement line
+    for record in records:
+        if not isinstance(record, brat.TextBound):
+            continue
+        status, spans = check(record, text, window)
+        if status == "ok":
+            continue
+        if spans is None:
+            found = " ".join(text.slice(max(start, 0), min(end, len(text))) for start, end in record.spans)
+            problems.append((record.id, status, f"{record.spans} is {found!r}, not {record.text!r}"))
+        else:
+            problems.append((record.id, status, f"{record.spans} -> {spans}" + (" (repaired)" if repair else "")))
+            repaired[record.id] = entity_line(record, spans)
+
+    if repair and repaired:
+        tmp_path = ann_path.with_name(f"{ann_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf8", newline="") as f:
+                for line in lines:
+                    tag_id = line.partition("\t")[0]
+                    if tag_id in repaired:
+                        newline = line[len(line.rstrip("\r\n")):] # keep the file's own line endings
+                        line = repaired[tag_id].rstrip("\n") + newline
+                    f.write(line)
+            os.replace(tmp_path, ann_path)
+        except:
+            os.remove(tmp_path)
+            raise
+    return ann_path, problems
+
+
+def find_ann(paths: list[Path]) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(path.rglob("*.ann")))
+        elif path.suffix == ".ann":
+            files.append(path)
+    return files
+
+
+@click.command()
+@click.argument('paths', type=click.Path(exists=True), nargs=-1, required=True)
+@click.option('--repair', is_flag=True, help="rewrite offsets shifted by line endings or a small drift")
+@click.option('--window', type=int, default=64, help="how far (characters) to look for a drifted entity")
+@click.option('--processes', type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+def main(paths, repair, window, processes):
+    """
+    paths are .ann files or folders searched recursively for them, each .ann with its .txt next to it
+    """
+    files = find_ann([Path(path) for path in paths])
+    tasks = [(path, repair, window) for path in files]
+
+    unresolved = 0
+    n_repaired = 0
+    with Pool(processes) as pool:
+        for ann_path, problems in pool.imap_unordered(verify_file, tasks, chunksize=32):
+            for tag_id, status, detail in problems:
+                print(f"{ann_path}:{tag_id}\t{status}\t{detail}")
+                if repair and status in ("crlf", "lf", "shift"):
+                    n_repaired += 1
+                else:
+                    unresolved += 1
+
+    print(f"{len(files)} files checked, {n_repaired} entities repaired, {unresolved} problems left", file=sys.stderr)
+    sys.exit(1 if unresolved else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,354 +7,223 @@ date: 19 July 2022
 This script was used to check for any entity annotations that were lacking in attributes, so that we 
 could make sure it wasn't by mistake. 
 
+It now validates every .ann file under a directory, in parallel, against the rules in validate:
+    missing_attribute, unexpected_attribute, invalid_attribute_value, unknown_entity_type,
+    dangling_relation, dangling_attribute, offset_out_of_range, text_mismatch, missing_txt, parse_error
+and writes a report with the issues of every file (.jsonl, or .csv of counts per file and rule), plus
+counts per annotator and per rule. Files unchanged since the last run keep their results.
+
 """
 
 from pathlib import Path
 import click
-from dataclasses import dataclass, field, KW_ONLY
-from typing import Optional, Type, TypeVar
-from abc import ABC, abstractmethod
-import shutil
-import os
+from typing import Iterable, Optional
 import re
+import os
+import csv
+import json
+import hashlib
 from pprint import pprint
-from collections import Counter
-
-T = TypeVar('T')
-
-class Markable(ABC):
-    """
-    Cause y'all can't behave
-    """
-    @abstractmethod
-    def mark(self, color):
-        raise NotImplementedError
-
-    @abstractmethod
-    def base(self):
-        raise NotImplementedError
-
-
-@dataclass
-class Entity(Markable):
-    _: KW_ONLY
-    entity_type: str
-    text: str
-    indexes: list[list[int]] # need multiple to account for sentence fragments
-    marking: str = ""
-
-    def mark(self: Type[T], color: str) -> T:
-        self.marking = color
-        return self
-
-    def base(self: Type[T]) -> T:
-        return self.__class__(entity_type=self.entity_type, text = self.text, indexes=self.indexes)
-
-    def to_ann(self, tag_id: str):
-        spans = ";".join([" ".join(span) for span in self.indexes])
-        append = "_" + self.marking if self.marking else ""
-        return tag_id + "\t" + self.entity_type + append + " " + spans + "\t" + self.text + "\n"
-
-
-
-
-# ENTITY TYPES
-@dataclass
-class Event(Entity):
-    entity_type: str = "Event"
-    childhood_trauma: bool = False
-    factuality: str = "Factual" # options: Factual|Maybe|Unlikely
-    event_type: Optional[str] = None # options: Sexual|Physical|Emotional|Other
-
-@dataclass
-class Temporal_Frame(Entity):
-    entity_type: str = "Temporal_Frame"
-    temporal_type: Optional[str] = None # options: Age|Period|Time-of-Life|Event|Date
-
-@dataclass
-class Symptom(Entity):
-    entity_type: str = "Symptom"
-    negation: bool = False
-    not_current_symptom: bool = False
-
-@dataclass
-class Perpetrator(Entity):
-    entity_type: str = "Perpetrator"
-    perpetrator_type: Optional[str] = None # options: Family-Member|Colleague|Partner|Other-Known|Other-Unknown
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from tqdm import tqdm
 
-@dataclass
-class Substance(Entity):
-    entity_type: str = "Substance"
+import brat
+import offsets
+from adjudication import ENTITY_CLASSES, Flag # one annotation model for both tools
 
-@dataclass
-class Relation(Markable):
-    arg1: Entity
-    arg2: Entity
-    relation_type: str
-    marking: str = ""
+RULES_VERSION = 2 # part of the saved state, bump when the rules change so every file is validated again
 
-    def mark(self, color):
-        return self.__class__(self.arg1, self.arg2, self.relation_type, marking= color)
+# attributes every entity of a type should have, the rest are flags or have a default (Factuality)
+REQUIRED_ATTRIBUTES = {"Event": ["Event_Type"], "Temporal_Frame": ["Temporal_Type"], "Perpetrator": ["Perpetrator_Type"]}
 
-    def base(self):
-        """
-        super useful idk what ur talking about
-        """
-        return self
 
+def issue(rule: str, tag_id: str, detail: str) -> dict:
+    return {"rule": rule, "id": tag_id, "detail": detail}
 
-@dataclass
-class Document:
-    ann_entities: list = field(default_factory=dict) # starts as dict, turns into list
-    ann_relations: list = field(default_factory=list)
 
-
-
-def attribute2string(a: int, attribute_type: str ,tag_id: str, text: str="") -> str:
-    text = " " + text if text else ""
-    return "A" + str(a) + "\t" + attribute_type +" " + tag_id + text + "\n"
-
-
-
-
-def revert_ann(doc: Document) -> list:
+def validate(ann: Iterable[str], text: Optional[offsets.Text]) -> tuple[list[dict], Counter]:
     """
-    Converts Document back to .ann file
+    Checks one .ann file against its .txt (None when there isn't one)
+
+    returns the issues found, as {"rule", "id", "detail"} dicts, and the count of each entity and relation type
     """
-    e = 0 # entity count
-    a = 0 # attribute count
-    r = 0 # relation count
-    new_entity_mapping = []
-    file = []
-
-    for entity in doc.ann_entities:
-
-        tag_id = "T"+ str(e)
-        new_entity_mapping.append((tag_id, entity)) # entities mutable so can't use dict
-        file.append(entity.to_ann(tag_id))
-        e += 1 # increment entity count
-
-        # Decompose Attributes
-        match entity.entity_type:
-            case "Event":
-                # childhood_trauma
-                if entity.childhood_trauma:
-                    file.append(attribute2string(a, "Childhood_Trauma", tag_id))
-                    a += 1 # increment attribute count (A1 -> A2 etc.)
-                # factuality
-                file.append(attribute2string(a, "Factuality",tag_id,entity.factuality))
-                a+=1
-                # event_type
-                if entity.event_type:
-                    file.append(attribute2string(a,"Event_Type",tag_id,entity.event_type))
-                    a+=1
-
-            case "Symptom":
-                # not_current_symptom
-                if entity.not_current_symptom:
-                    file.append(attribute2string(a,"Not_Current_Symptom", tag_id))
-                    a += 1
-
-                # negation
-                if entity.negation:
-                    file.append(attribute2string(a,"Negation", tag_id))
-                    a += 1
-
-            case "Perpetrator":
-                if entity.perpetrator_type:
-                    file.append(attribute2string(a,"Perpetrator_Type", tag_id, entity.perpetrator_type))
-                    a += 1
-            case "Temporal_Frame":
-                if entity.temporal_type:
-                    file.append(attribute2string(a,"Temporal_Type",tag_id,entity.temporal_type))
-                    a += 1
-        
-
-    for relation in doc.ann_relations:
-        tag_id = "R" + str(r)
-
-        for entity_id, entity in new_entity_mapping:
-            if relation.arg1 == entity.base():
-                arg1_id = entity_id
-            if relation.arg2 == entity.base():
-                arg2_id = entity_id
-
-        append = "_" + relation.marking if relation.marking else ""
-
-        file.append(tag_id + "\t" + relation.relation_type + append +" Arg1:" + arg1_id + " Arg2:" + arg2_id + "\n") 
-        r += 1 # increment relation count
-
-
-    return file
-
-
-def check_unattributed(doc:Document) -> Document:
-
-    kounter = Counter()
-    for i,entity in enumerate(doc.ann_entities):
-
-        # if entity.marking == "red":
-        #     continue
-        kounter[entity.entity_type] += 1
-        # match entity.entity_type:
-        #     case "Event":
-        #        # if not entity.event_type:
-        #        #      doc.ann_entities[i] = entity.mark("yellow")
-        #         kounter["Event"] +=1
-        #     case "Temporal_Frame":
-        #         #if not entity.temporal_type:
-        #             #doc.ann_entities[i] = entity.mark("yellow")
-        #         kounter["TF"] += 1
-
-        #     case "Perpetrator":
-        #         #if not entity.perpetrator_type:
-        #             #doc.ann_entities[i] = entity.mark("yellow")
-                
-    for relation in doc.ann_relations:
-        kounter[relation.relation_type]+=1
-    return doc, kounter
-
-
-
-def check_marking(entity_type):
-    marking = ""
-    if entity_type[-4:] == "_red":
-        marking = "red"
-    elif entity_type[-7:]=="_yellow":
-        marking = "yellow"
-    return marking
-
-def convert_ann(file: list) -> Document: 
+    issues = []
+    types = Counter()
+    try:
+        records = list(brat.parse(ann))
+    except ValueError as e:
+        return [issue("parse_error", "", str(e))], types
+    if text is None:
+        issues.append(issue("missing_txt", "", "no .txt next to the .ann, offsets not checked"))
+
+    entities = {record.id: record for record in records if isinstance(record, brat.TextBound)}
+    ids = entities.keys() | {record.id for record in records if isinstance(record, brat.Event)}
+    attributes = defaultdict(dict) # entity id -> {name: value}
+    for record in records:
+        if isinstance(record, brat.Attribute):
+            if record.target not in ids:
+                issues.append(issue("dangling_attribute", record.id, f"{record.name} of {record.target}, which isn't an annotation"))
+            attributes[record.target][record.name] = record.value
+        elif isinstance(record, brat.Relation):
+            types[record.type] += 1
+            for arg in (record.arg1, record.arg2):
+                if arg not in ids:
+                    issues.append(issue("dangling_relation", record.id, f"{record.type} argument {arg} isn't an annotation"))
+
+    for entity in entities.values():
+        entity_type = re.split("_red|_yellow", entity.type)[0]
+        types[entity_type] += 1
+        entity_class = ENTITY_CLASSES.get(entity_type)
+        if entity_class is None:
+            issues.append(issue("unknown_entity_type", entity.id, entity.type))
+        else:
+            for name in REQUIRED_ATTRIBUTES.get(entity_type, []):
+                if name not in attributes[entity.id]:
+                    issues.append(issue("missing_attribute", entity.id, f"{entity_type} {entity.text!r} has no {name}"))
+            for name, value in attributes[entity.id].items():
+                flag = getattr(entity_class, name.lower(), None)
+                if not isinstance(flag, Flag):
+                    issues.append(issue("unexpected_attribute", entity.id, f"{entity_type} can't have {name}"))
+                elif flag.values[1] is not True and value not in flag.values: # only valued attributes, flags have no value
+                    issues.append(issue("invalid_attribute_value", entity.id, f"{name} {value!r}"))
+
+        if text is not None:
+            status, spans = offsets.check(entity, text)
+            if status == "out_of_range":
+                issues.append(issue("offset_out_of_range", entity.id, f"{entity.spans} in a text of {len(text)} characters"))
+            elif spans is not None:
+                issues.append(issue("text_mismatch", entity.id, f"{entity.text!r} is at {spans} ({status}), offsets.py --repair moves it"))
+            elif status != "ok":
+                found = " ".join(text.slice(start, end) for start, end in entity.spans) # BRAT joins fragments with a space
+                issues.append(issue("text_mismatch", entity.id, f"{entity.text!r} but the text there is {found!r}"))
+
+    return issues, types
+
+
+def stamp(ann_path: Path) -> list:
     """
-    Converts a brat annotation .ann file to a doc, which has two attributes:
-        a dictionary of entitities, and a dictionary of relations. 
-
-    ann_file: .ann file read in as list
+    mtime and size of the .ann and its .txt, a file whose stamp hasn't changed isn't read again
     """
-    doc = Document()
-
-
-    for line in file:
-
-        tokens = line.split()
-
-        if tokens[0][0] == "T": # Entity
-
-            # Deal with sentence fragments
-            this_id, rest, text = line.strip().split("\t")
-            entity_type, *span = rest.split()
-            indexes = [tuple(tmp.split()) for tmp in " ".join(span).split(";")]     # self explanatory
-
-            match re.split("_red|_yellow",entity_type)[0]:
-
-                case "Symptom":
-
-                    entity = Symptom(text = text,indexes=indexes,marking=check_marking(entity_type))
-
-                case "Temporal_Frame":
-                    entity = Temporal_Frame(text = text,indexes=indexes,marking=check_marking(entity_type))
-
-                case "Perpetrator":
-                    entity = Perpetrator(text = text,indexes=indexes,marking=check_marking(entity_type))
-
-                case "Event":
-                    entity = Event(text = text,indexes=indexes,marking=check_marking(entity_type))
+    txt_path = ann_path.with_suffix(".txt")
+    ann_stat = ann_path.stat()
+    txt_stat = txt_path.stat() if txt_path.exists() else None
+    return [ann_stat.st_mtime_ns, ann_stat.st_size, txt_stat and txt_stat.st_mtime_ns, txt_stat and txt_stat.st_size]
 
-                case "Substance":
-                    entity = Substance(text = text,indexes=indexes,marking=check_marking(entity_type))
 
+def validate_file(task: tuple[Path, Optional[str]]) -> tuple[Path, str, Optional[list], Optional[Counter]]:
+    """
+    task is (.ann path, hash of the .ann and .txt at the last run or None)
 
-            doc.ann_entities[this_id] = entity
-
-
-
-        elif tokens[0][0] == "A": # Attribute
-            # If the line is an attribute, find the corresponding entity and update (marked by parent_id)
-            parent_id = tokens[2]
-
-            match tokens[1]:
-
-                case "Perpetrator_Type":
-                    doc.ann_entities[parent_id].perpetrator_type = tokens[3]
-
-                case "Temporal_Type":
-                    doc.ann_entities[parent_id].temporal_type = tokens[3]
-
-                case "Event_Type":
-                    doc.ann_entities[parent_id].event_type = tokens[3]
-
-                case "Not_Current_Symptom":
-                    doc.ann_entities[parent_id].not_current_symptom = True
-
-                case "Childhood_Trauma":
-                    doc.ann_entities[parent_id].childhood_trauma = True
-
-                case "Negation":
-                    try:
-                        doc.ann_entities[parent_id].negation = True
-                    except KeyError:
-                        pass
-                case "Factuality":
-                    doc.ann_entities[parent_id].factuality = tokens[3]
-
-        elif tokens[0][0] == "R": # Relation
-
-            relation_type, arg1, arg2 = tokens[1::]
-            arg1_id = arg1[5:]
-            arg2_id = arg2[5:]
-            doc.ann_relations.append(Relation(doc.ann_entities[arg1_id].base(), doc.ann_entities[arg2_id].base(), relation_type))
-
-
-    doc.ann_entities = list(doc.ann_entities.values())
-
-    return doc
-
-
-def pipeline(file):
-    print(file)
-    with open(file,"r") as f:
-        ann = f.readlines()
-
-    doc = convert_ann(ann)
-
-    doc, kounter = check_unattributed(doc)
-    ann = revert_ann(doc)
+    returns the path, the hash, and the issues and types, which are None when the hash hasn't changed
+    """
+    ann_path, previous_hash = task
+    txt_path = ann_path.with_suffix(".txt")
+    ann_bytes = ann_path.read_bytes()
+    txt_bytes = txt_path.read_bytes() if txt_path.exists() else None
+    digest = hashlib.sha1(ann_bytes + b"\0" + (txt_bytes or b"")).hexdigest()
+    if digest == previous_hash:
+        return ann_path, digest, None, None
+
+    try:
+        # not newline translated: BRAT offsets count a CRLF as two characters
+        text = offsets.Text(txt_bytes) if txt_bytes is not None else None
+        ann = ann_bytes.decode("utf8").split("\n")
+    except UnicodeDecodeError as e:
+        return ann_path, digest, [issue("parse_error", "", f"not utf8: {e}")], Counter()
+    issues, types = validate(ann, text)
+    return ann_path, digest, issues, types
+
+
+def write_report(report_path: Path, results: dict) -> None:
+    """
+    results: relative path -> {"annotator", "issues", "types"}. .csv reports get a row per file and rule with
+    its count, anything else is JSON lines with every issue of every file
+    """
+    tmp_path = report_path.with_name(f"{report_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf8", newline="") as f:
+            if report_path.suffix == ".csv":
+                writer = csv.writer(f)
+                writer.writerow(["file", "annotator", "rule", "count"])
+                for name, result in sorted(results.items()):
+                    for rule, count in sorted(Counter(issue["rule"] for issue in result["issues"]).items()):
+                        writer.writerow([name, result["annotator"], rule, count])
+            else:
+                for name, result in sorted(results.items()):
+                    counts = Counter(issue["rule"] for issue in result["issues"])
+                    f.write(json.dumps({"file": name, "annotator": result["annotator"], "counts": counts,
+                                        "issues": result["issues"], "types": result["types"]}) + "\n")
+        os.replace(tmp_path, report_path)
+    except:
+        os.remove(tmp_path)
+        raise
 
-    # with open(file,"w") as f:
-    #     for line in ann:x
-    #         f.write(line) 
-    return kounter
 
 @click.command()
 @click.argument('dir_path', type=click.Path(exists=True), required=True)
-def main(dir_path):
+@click.option('--report', type=click.Path(), default=None, help="where to write the report, .jsonl or .csv, defaults to dir_path/validation.jsonl")
+@click.option('--processes', type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+@click.option('--fresh', is_flag=True, help="validate every file again, instead of reusing results for unchanged ones")
+def main(dir_path, report, processes, fresh):
     """
-    dir_path is path to folder called EHR
+    dir_path is any folder of .ann files (like the folder called EHR), searched recursively, with each .txt next
+    to its .ann. A file's annotator is the name of the directory it's in.
     """
     dir_path = Path(dir_path)
-    kounter = Counter()
-    for annotator in ["combined"]:
-        for file in (dir_path/annotator).glob("*.ann"):
-            temp = pipeline(file)
-            if temp:
-                kounter += temp
-
-
-    pprint(kounter)
+    report_path = Path(report) if report else dir_path/"validation.jsonl"
+    state_path = dir_path/".validation-state.json"
+
+    state = {}
+    if state_path.exists() and not fresh:
+        with open(state_path, encoding="utf8") as f:
+            state = json.load(f)
+        if state.get("version") != RULES_VERSION:
+            state = {}
+    files = state.get("files", {})
+
+    results = {}
+    tasks = []
+    for ann_path in sorted(dir_path.rglob("*.ann")):
+        name = ann_path.relative_to(dir_path).as_posix()
+        previous = files.get(name)
+        current = stamp(ann_path)
+        if previous and previous["stamp"] == current:
+            results[name] = previous
+        else:
+            tasks.append((ann_path, previous and previous["hash"]))
+            results[name] = {"annotator": ann_path.parent.name, "stamp": current}
+
+    validated = 0
+    with Pool(processes) as pool:
+        for ann_path, digest, issues, types in tqdm(pool.imap_unordered(validate_file, tasks, chunksize=16), total=len(tasks), desc="Validating"):
+            name = ann_path.relative_to(dir_path).as_posix()
+            result = results[name]
+            result["hash"] = digest
+            if issues is None: # touched but not changed
+                result.update(issues=files[name]["issues"], types=files[name]["types"])
+            else:
+                result.update(issues=issues, types=types)
+                validated += 1
+
+    write_report(report_path, results)
+    tmp_path = state_path.with_name(f"{state_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump({"version": RULES_VERSION, "files": results}, f)
+    os.replace(tmp_path, state_path)
+
+    per_rule, per_annotator, types = Counter(), defaultdict(Counter), Counter()
+    for result in results.values():
+        for found in result["issues"]:
+            per_rule[found["rule"]] += 1
+            per_annotator[result["annotator"]][found["rule"]] += 1
+        types.update(result["types"])
+    pprint(types)
+    for annotator, counts in sorted(per_annotator.items()):
+        print(annotator, "\t".join(f"{rule} {count}" for rule, count in sorted(counts.items())), sep="\t")
+    print(f"{len(results)} files, {validated} validated, {len(results) - validated} unchanged since the last run: "
+          + ", ".join(f"{rule} {count}" for rule, count in per_rule.most_common()))
+    print(f"report written to {report_path}")
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
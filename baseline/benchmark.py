@@ -0,0 +1,368 @@
+"""
+Benchmarks for ingest.py, checks the fast paths give the same output as the code they replaced, and a load test
+of serve.py
+
+python benchmark.py (bench_sharded needs mongomock)
+"""
+
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from collections import defaultdict
+from itertools import product
+
+from ingest import label_tokens, build_df, full_dataset, sharded_dataset, build_relation_df, parse, parse_documents, spans, simplify_label
+
+
+def label_tokens_loop(df: pd.DataFrame, ann_entities: dict, simple=True) -> pd.DataFrame:
+    """
+    token labeling as spans used to do it, row by row
+    """
+    from ingest import entity_label
+    for entity_id, entity in ann_entities.items():
+        entity_type = entity_label(entity, simple)
+        for span in entity["indexes"]:
+            for index in df.index:
+                if df.loc[index, "position"] == int(span[0]):
+                    k = 0
+                    nrows = df.shape[0]
+                    while k <= nrows and df.loc[index + k, "position"] < int(span[1]):
+                        df.at[index + k, "labels"] = entity_type
+                        df.at[index+k, "entity_id"] = entity_id
+                        k += 1
+    return df
+
+
+def synthetic_document(n_tokens: int, n_entities: int, seed: int = 0) -> tuple[np.ndarray, dict]:
+    """
+    token offsets and BRAT-like entities over them, some spans discontinuous and some not starting on a token
+    """
+    rng = random.Random(seed)
+    positions = np.cumsum([rng.randint(1, 9) for _ in range(n_tokens)]).astype(np.int64)
+    entities = {}
+    for i in range(n_entities):
+        indexes = []
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            first = rng.randrange(n_tokens - 10)
+            start = int(positions[first]) + (1 if rng.random() < 0.05 else 0)
+            end = int(positions[first + rng.randint(1, 6)]) - rng.randint(0, 1)
+            indexes.append([str(start), str(end)])
+        entities[f"T{i}"] = {"entity_type": rng.choice(["event", "symptom", "perpetrator", "temporal_frame"]), "indexes": indexes}
+    return positions, entities
+
+
+def bench_label_tokens(n_tokens: int = 3000, n_entities: int = 60, n_docs: int = 3) -> None:
+    old_time = new_time = 0
+    for seed in range(n_docs):
+        positions, entities = synthetic_document(n_tokens, n_entities, seed)
+        df = pd.DataFrame({"entity_id": [None] * n_tokens, "position": positions, "labels": ["O"] * n_tokens})
+
+        start = time.perf_counter()
+        old = label_tokens_loop(df, entities)
+        old_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        labels, entity_ids = label_tokens(positions, entities)
+        new_time += time.perf_counter() - start
+
+        assert list(old["labels"]) == list(labels) and list(old["entity_id"]) == list(entity_ids)
+
+    print(f"label_tokens ({n_docs} docs, {n_tokens} tokens, {n_entities} entities): "
+          f"loop {old_time:.3f}s, searchsorted {new_time:.4f}s, {old_time / new_time:.0f}x")
+
+
+def build_df_loop(df_spans: pd.DataFrame) -> pd.DataFrame:
+    """
+    collection level sentence ids as build_df used to do it, row by row
+    """
+    kounter = 0
+    prev = 0
+    for index, row in df_spans.iterrows():
+        current = df_spans.loc[index,"sentence_id"]
+        if current != prev:
+            prev = current
+            kounter += 1
+        df_spans.loc[index,"sentence_id"] = kounter
+    return df_spans
+
+
+def synthetic_spans(n_docs: int, seed: int = 0) -> list[pd.DataFrame]:
+    """
+    per document span frames, with document level sentence ids
+    """
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(n_docs):
+        sentence_ids = [i for i in range(rng.randint(1, 30)) for _ in range(rng.randint(1, 25))]
+        frames.append(pd.DataFrame({"token": ["tok"] * len(sentence_ids), "sentence_id": sentence_ids,
+                                    "entity_id": [None] * len(sentence_ids), "position": range(len(sentence_ids)),
+                                    "labels": ["O"] * len(sentence_ids)}))
+    return frames
+
+
+def bench_build_df(n_docs: int = 200) -> None:
+    frames = synthetic_spans(n_docs)
+
+    start = time.perf_counter()
+    combined = pd.DataFrame()
+    for frame in frames:
+        combined = pd.concat([combined, frame], ignore_index=True)
+    old = build_df_loop(combined)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = build_df(pd.concat([pd.DataFrame()] + frames, ignore_index=True))
+    new_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(old, new)
+    print(f"assembly + build_df ({n_docs} docs, {len(new)} tokens): "
+          f"concat per doc + iterrows {old_time:.3f}s, single concat + cumsum {new_time:.4f}s, {old_time / new_time:.0f}x")
+
+
+def synthetic_mongo_documents(n_docs: int, seed: int = 0) -> list[dict]:
+    """
+    documents shaped like db.r21.documents, with ascending _ids
+    """
+    rng = random.Random(seed)
+    vocab = "he was kicked by his father . she felt sad and hopeless . at age 12 the uncle hit her . she denies si".split()
+    documents = []
+    for i in range(n_docs):
+        words = [rng.choice(vocab) for _ in range(rng.randint(50, 400))] + ["end", "."]
+        text = " ".join(words)
+        offsets = np.cumsum([0] + [len(word) + 1 for word in words[:-1]])
+        entities = {}
+        for e in range(rng.randint(0, 15)):
+            j = rng.randrange(len(words) - 1)
+            entities[f"T{e}"] = {"entity_type": rng.choice(["event", "perpetrator", "temporal_frame", "symptom"]), "text": words[j],
+                                 "indexes": [[str(offsets[j]), str(offsets[j] + len(words[j]))]]}
+        relations = {}
+        for r in range(min(len(entities) // 2, 4)):
+            arg1, arg2 = rng.sample(list(entities), 2)
+            relations[f"R{r}"] = {"arg1_id": arg1, "arg2_id": arg2, "relation_type": rng.choice(["perpetrated_by", "grounded_to", "sub-event"])}
+        documents.append({"_id": i, "text": text, "ann_entities": entities, "ann_relations": relations, "annotator": "unused"})
+    return documents
+
+
+def fixture_collection(documents: list[dict]):
+    """
+    local stand-in for db.r21.documents
+    """
+    import mongomock
+    collection = mongomock.MongoClient().r21.documents
+    collection.insert_many(documents)
+    return collection
+
+
+def bench_sharded(n_docs: int = 400, n_shards: int = 4, n_process: int = 4) -> None:
+    collection = fixture_collection(synthetic_mongo_documents(n_docs))
+
+    start = time.perf_counter()
+    serial_spans, serial_relations = full_dataset(collection=collection)
+    serial_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        sharded_spans, sharded_relations = sharded_dataset(out_dir, n_shards=n_shards, n_process=n_process, batch_size=32, collection=collection)
+        sharded_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(serial_spans, sharded_spans)
+    pd.testing.assert_frame_equal(serial_relations, sharded_relations)
+    print(f"ingestion ({n_docs} docs): serial {n_docs / serial_time:.1f} docs/s, "
+          f"{n_shards} shards / {n_process} processes {n_docs / sharded_time:.1f} docs/s")
+
+
+def relation_combination_frame(sentence_text, entities):
+    """
+    candidates of one sentence as relation_combination used to make them, a DataFrame per sentence
+    """
+    types = defaultdict(list)
+    if len(entities) < 2:
+        return pd.DataFrame([], columns=["e1","e2","sentence_text"])
+    for entity_id, label in entities:
+        types[label].append(entity_id)
+    perpetrated_by = list(product(types["event"], types["perpetrator"]))
+    subevents = [(a,b) for a,b in product(types['event'], types["event"]) if a != b]
+    grounded_to = list(product(types["event"], types["temporal_frame"]))
+    return pd.DataFrame([(a,b,str(sentence_text)) for a,b in perpetrated_by + subevents + grounded_to], columns = ["e1","e2","sentence_text"])
+
+
+def build_relation_df_loop(span_df: pd.DataFrame, doc, tokens) -> pd.DataFrame:
+    """
+    build_relation_df as it used to be, grouping with iterrows and concatenating a frame per sentence
+    """
+    sentence_entities = defaultdict(set)
+    relation_dfs = [pd.DataFrame([], columns=["e1","e2"])]
+    sents = [sent.text for sent in tokens.sents]
+    for _, row in span_df.iterrows():
+        if row["entity_id"]:
+            sentence_entities[row["sentence_id"]].add((row["entity_id"], simplify_label(row["labels"])))
+    for sentence_id, entities in sentence_entities.items():
+        relation_dfs.append(relation_combination_frame(sents[sentence_id], entities))
+    relation_df = pd.concat(relation_dfs, ignore_index=True)
+    true_relations = {(relation["arg1_id"], relation["arg2_id"]): relation["relation_type"] for relation in doc["ann_relations"].values()}
+    relation_df["labels"] = [true_relations.get((row["e1"], row["e2"]), "no_relation") for _, row in relation_df.iterrows()]
+    relation_df["e1"] = [doc["ann_entities"][e]["text"] for e in relation_df["e1"]]
+    relation_df["e2"] = [doc["ann_entities"][e]["text"] for e in relation_df["e2"]]
+    return relation_df
+
+
+def bench_relation_candidates(n_docs: int = 200) -> None:
+    parsed = []
+    for doc in synthetic_mongo_documents(n_docs, seed=1):
+        tokens = parse(doc)
+        parsed.append((doc, tokens, spans(doc, tokens=tokens)))
+
+    start = time.perf_counter()
+    old = [build_relation_df_loop(spans_df, doc, tokens) for doc, tokens, spans_df in parsed]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = [build_relation_df(spans_df, doc, tokens) for doc, tokens, spans_df in parsed]
+    new_time = time.perf_counter() - start
+
+    columns = ["e1", "e2", "sentence_text", "labels"]
+    for before, after in zip(old, new): # same candidates, the loop listed them in set order within a sentence
+        assert len(before) == len(after)
+        assert before.empty or sorted(map(tuple, before[columns].values.tolist())) == sorted(map(tuple, after[columns].values.tolist()))
+    print(f"build_relation_df ({n_docs} docs, {sum(map(len, new))} candidates): "
+          f"iterrows + frame per sentence {old_time:.2f}s, relation_candidates {new_time:.3f}s, {old_time / new_time:.0f}x")
+    for window in (1, 2, 4):
+        start = time.perf_counter()
+        n_candidates = sum(len(build_relation_df(spans_df, doc, tokens, window)) for doc, tokens, spans_df in parsed)
+        print(f"    window {window}: {n_candidates} candidates, {time.perf_counter() - start:.3f}s")
+
+
+# VmHWM rather than ru_maxrss, which Linux carries over from the forking process across exec
+LOAD_SCRIPT = """
+import re, sys, time
+import dataset
+start = time.perf_counter()
+df = dataset.load(sys.argv[1], columns=sys.argv[2].split(",") if sys.argv[2] else None)
+load_time = time.perf_counter() - start
+with open("/proc/self/status") as status:
+    peak = int(re.search(r"VmHWM:\\s+(\\d+)", status.read()).group(1)) / 1024
+print(load_time, peak, len(df))
+"""
+
+
+def measure_load(path, columns: str = "") -> tuple[float, float]:
+    """
+    load time and peak RSS (MB, Linux) of dataset.load in a fresh process
+    """
+    output = subprocess.run([sys.executable, "-c", LOAD_SCRIPT, str(path), columns], capture_output=True, text=True,
+                            check=True, cwd=Path(__file__).parent).stdout.split()
+    return float(output[0]), float(output[1])
+
+
+def bench_dataset_format(n_tokens: int = 5_000_000) -> None:
+    import dataset
+    rng = np.random.default_rng(0)
+    vocab = np.array([f"word{i}" for i in range(20_000)], dtype=object)
+    labels = np.array(["O"] * 20 + ["event", "symptom", "perpetrator", "temporal_frame"], dtype=object)
+    spans_df = pd.DataFrame({"token": vocab[rng.integers(0, len(vocab), n_tokens)],
+                             "sentence_id": np.arange(n_tokens) // 20,
+                             "entity_id": None,
+                             "position": np.arange(n_tokens) % 20_000 * 5,
+                             "labels": labels[rng.integers(0, len(labels), n_tokens)]})
+    spans_df.loc[spans_df["labels"] != "O", "entity_id"] = "T1"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        spans_df.to_pickle(Path(tmp) / "spans.pkl")
+        dataset.write(spans_df, Path(tmp) / "spans.parquet")
+        for name, columns in [("spans.pkl", ""), ("spans.parquet", ""), ("spans.pkl", "sentence_id,token,labels"), ("spans.parquet", "sentence_id,token,labels")]:
+            load_time, peak = measure_load(Path(tmp) / name, columns)
+            print(f"load {name} ({n_tokens} tokens, columns: {columns or 'all'}): {load_time:.2f}s, peak RSS {peak:.0f} MB")
+
+
+def synthetic_notes(n_notes: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(500)] + ["hit", "kicked", "mother", "father", "yesterday"] * 10
+    return [" ".join(" ".join(rng.choice(words) for _ in range(rng.randint(5, 25))) + "."
+                     for _ in range(rng.randint(2, 40)))
+            for _ in range(n_notes)]
+
+
+def load_test(batcher, notes: list[str], n_clients: int) -> tuple[float, float, float]:
+    """
+    n_clients threads each submitting a note and waiting for it, until notes run out
+    returns p50 and p99 latency (ms) and notes/s
+    """
+    import threading
+    latencies = []
+    remaining = iter(notes)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                note = next(remaining, None)
+            if note is None:
+                return
+            start = time.perf_counter()
+            batcher.submit(note).result()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return p50, p99, len(notes) / elapsed
+
+
+def bench_serve(n_notes: int = 400, n_clients: int = 16) -> None:
+    import os
+    import pickle
+    import dataset
+    from serve import Annotator, Batcher
+
+    # models fit on the synthetic notes themselves, the point is the serving overhead
+    labels = {"hit": "event", "kicked": "event", "mother": "perpetrator", "father": "perpetrator", "yesterday": "temporal_frame"}
+    frames = [spans({"ann_entities": {}}, tokens=tokens) for _, tokens in
+              parse_documents(({"text": text} for text in synthetic_notes(100, seed=1)), batch_size=100)]
+    train = build_df(pd.concat(frames, ignore_index=True))
+    train["labels"] = [labels.get(token, "O") for token in train["token"]]
+    rng = np.random.default_rng(0)
+    relations = pd.DataFrame({"e1": rng.choice(["hit", "kicked"], 2000), "e2": rng.choice(["mother", "father", "yesterday"], 2000),
+                              "sentence_text": [f"word{i % 50} hit word2 mother" for i in range(2000)], "candidate": "perpetrated_by",
+                              "labels": rng.choice(["perpetrated_by", "no_relation"], 2000)})
+
+    # fit and pickled by linear_baseline.py run as a script, and loaded as serve.py loads them
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        dataset.write(train, tmp / "spans.parquet")
+        dataset.write(relations, tmp / "relations.parquet")
+        subprocess.run([sys.executable, "linear_baseline.py", "--spans", str(tmp / "spans.parquet"), "--relations", str(tmp / "relations.parquet"),
+                        "--output", str(tmp / "linear_models")], capture_output=True, check=True, cwd=Path(__file__).parent,
+                       env={**os.environ, "SPLIT_DIR": str(tmp / "splits")})
+        with open(tmp / "linear_models" / "tokens.pkl", "rb") as f:
+            tagger = pickle.load(f)
+        with open(tmp / "linear_models" / "relations.pkl", "rb") as f:
+            classifier = pickle.load(f)
+    for model, name in [(tagger, "linear_baseline.TokenTagger"), (classifier, "linear_baseline.RelationClassifier")]:
+        assert f"{type(model).__module__}.{type(model).__qualname__}" == name, type(model)
+
+    notes = synthetic_notes(n_notes)
+    for max_batch, max_wait in [(1, 0.0), (16, 0.02), (32, 0.05)]:
+        batcher = Batcher(Annotator(tagger, classifier), max_batch=max_batch, max_wait=max_wait)
+        p50, p99, throughput = load_test(batcher, notes, n_clients)
+        print(f"serve ({n_notes} notes, {n_clients} clients, max batch {max_batch}, max wait {max_wait * 1000:.0f}ms): "
+              f"p50 {p50:.0f}ms, p99 {p99:.0f}ms, {throughput:.1f} notes/s")
+
+
+if __name__ == "__main__":
+    bench_label_tokens()
+    bench_build_df()
+    bench_relation_candidates()
+    bench_sharded()
+    bench_dataset_format()
+    bench_serve()
@@ -0,0 +1,75 @@
+"""
+Parquet storage for the datasets built by ingest.py (spans, relations), in place of pandas pickles.
+
+String columns are dictionary encoded (they come back as pandas categoricals), integer columns
+are downcast, and spans are partitioned by collection level sentence_id, so scripts can read only
+the columns and sentence ranges they need, memory mapped.
+"""
+
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DICTIONARY_COLUMNS = ["token", "labels", "entity_id", "e1", "e2", "sentence_text", "candidate"]
+PARTITION_SENTENCES = 50_000  # sentences per partition
+PARTITIONING = ds.partitioning(pa.schema([("partition", pa.int32())]), flavor="hive")
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    df = df.copy()
+    for name in df.columns:
+        if name in DICTIONARY_COLUMNS:
+            df[name] = df[name].astype("category")
+        elif pd.api.types.is_integer_dtype(df[name]):
+            df[name] = pd.to_numeric(df[name], downcast="integer")
+    if "sentence_id" in df.columns:
+        # widened first, a downcast int16 sentence_id can't hold PARTITION_SENTENCES
+        df["partition"] = (df["sentence_id"].astype(np.int64) // PARTITION_SENTENCES).astype("int32")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write(df: pd.DataFrame, path) -> None:
+    """
+    Writes df as a Parquet dataset directory at path, replacing whatever was there
+    """
+    path = Path(path)
+    if path.exists():
+        shutil.rmtree(path)
+    table = to_table(df)
+    if "partition" not in table.column_names:
+        path.mkdir(parents=True)
+        pq.write_table(table, path / "part-0.parquet")
+        return
+
+    # sentence ids only go up, so each partition is a contiguous run of rows. Zero padded so
+    # partitions list (and read) in order
+    partition_ids = table.column("partition").to_numpy()
+    bounds = np.flatnonzero(np.diff(partition_ids)) + 1
+    for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(partition_ids)]))):
+        partition_path = path / f"partition={partition_ids[start]:06d}"
+        partition_path.mkdir(parents=True)
+        pq.write_table(table.slice(start, end - start).drop(["partition"]), partition_path / "part-0.parquet")
+
+
+def load(path, columns: list[str] = None, partitions: list[int] = None) -> pd.DataFrame:
+    """
+    Reads a dataset written by write, memory mapped, with only the given columns and sentence_id
+    partitions (partition = sentence_id // PARTITION_SENTENCES). None reads everything.
+
+    .pkl paths are read with pd.read_pickle, for exports from before the Parquet format
+    """
+    if str(path).endswith(".pkl"):
+        df = pd.read_pickle(path)
+        if partitions is not None:
+            df = df[(df["sentence_id"] // PARTITION_SENTENCES).isin(partitions)]
+        return df[columns] if columns else df
+
+    filters = [("partition", "in", list(partitions))] if partitions is not None else None
+    table = pq.read_table(path, columns=columns, filters=filters, memory_map=True, partitioning=PARTITIONING)
+    if "partition" in table.column_names and not (columns and "partition" in columns):
+        table = table.drop(["partition"])
+    return table.to_pandas()
@@ -0,0 +1,146 @@
+"""
+Cache of the tokenized model inputs simpletransformers builds from a DataFrame (input_ids, attention masks,
+segment ids, label ids aligned to subwords), so the tokenizer runs once per dataset rather than once per run
+and per sweep trial.
+
+Features are stored as .npy arrays under feature_cache/<key>/ (the tensors of an NER TensorDataset, or the
+examples and labels of a ClassificationDataset), keyed by model class, tokenizer name, max sequence length,
+labels and a hash of the data, and loaded memory mapped (copy on write, nothing is read until a batch needs it).
+Use CachedNERModel and CachedClassificationModel in place of NERModel and ClassificationModel, everything else
+about them is unchanged.
+
+python features.py spans.parquet [relations.parquet]      prints the hash the cache keys each dataset on
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Optional
+import click
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import TensorDataset
+from simpletransformers.ner import NERModel
+from simpletransformers.classification import ClassificationModel
+from simpletransformers.classification.classification_utils import ClassificationDataset
+
+import dataset
+
+FEATURE_CACHE_VERSION = 2  # bump when what goes into the key changes
+FEATURE_CACHE_DIR = Path(os.environ.get("FEATURE_CACHE_DIR", "feature_cache"))
+
+
+def dataset_hash(data) -> str:
+    """
+    content hash of the data handed to a model, hashed column by column for DataFrames
+    """
+    digest = hashlib.sha256()
+    if isinstance(data, pd.DataFrame):
+        digest.update(json.dumps([str(name) for name in data.columns]).encode("utf8"))
+        digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    else:
+        digest.update(pickle.dumps(data, protocol=4))
+    return digest.hexdigest()
+
+
+def feature_key(model_class: str, tokenizer_name: str, max_length: int, labels: list, data_hash: str) -> str:
+    content = json.dumps([FEATURE_CACHE_VERSION, model_class, tokenizer_name, max_length, [str(label) for label in labels or []], data_hash])
+    return hashlib.sha256(content.encode("utf8")).hexdigest()[:32]
+
+
+def save_arrays(path: Path, arrays: dict[str, np.ndarray]) -> None:
+    """
+    writes each array as path/<name>.npy, into a temporary directory renamed into place
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    try:
+        for name, array in arrays.items():
+            np.save(tmp_path / f"{name}.npy", array)
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not path.exists(): # unless another process got there first
+            raise
+
+
+def load_arrays(path: Path) -> dict[str, np.ndarray]:
+    # copy on write, torch refuses read only arrays
+    return {file.stem: np.load(file, mmap_mode="c") for file in sorted(path.glob("*.npy"))}
+
+
+def dataset_arrays(dataset) -> Optional[dict[str, np.ndarray]]:
+    """
+    the arrays of a TensorDataset or a ClassificationDataset, None for anything else (lazy
+    datasets, the (dataset, window counts) of sliding window evaluation)
+    """
+    if isinstance(dataset, TensorDataset):
+        return {f"tensor_{i:02d}": tensor.numpy() for i, tensor in enumerate(dataset.tensors)}
+    if isinstance(dataset, ClassificationDataset):
+        arrays = {f"examples.{name}": tensor.numpy() for name, tensor in dataset.examples.items()}
+        arrays["labels"] = dataset.labels.numpy()
+        return arrays
+    return None
+
+
+def arrays_dataset(arrays: dict[str, np.ndarray]):
+    """
+    the dataset dataset_arrays took the arrays from
+    """
+    if "labels" not in arrays:
+        return TensorDataset(*[torch.from_numpy(array) for array in arrays.values()])
+    dataset = ClassificationDataset.__new__(ClassificationDataset) # without tokenizing again
+    dataset.examples = {name.split(".", 1)[1]: torch.from_numpy(array) for name, array in arrays.items() if name.startswith("examples.")}
+    dataset.labels = torch.from_numpy(arrays["labels"])
+    return dataset
+
+
+class FeatureCacheMixin:
+    """
+    Caches what load_and_cache_examples returns, a TensorDataset (NERModel) or ClassificationDataset
+    (ClassificationModel) of the features of the examples it's given
+    """
+    feature_cache_dir = FEATURE_CACHE_DIR
+
+    def load_and_cache_examples(self, examples, *args, **kwargs):
+        if examples is None or kwargs.get("to_predict") is not None: # predictions are tokenized as they come
+            return super().load_and_cache_examples(examples, *args, **kwargs)
+
+        tokenizer_name = self.args.tokenizer_name or self.args.model_name
+        labels = getattr(self.args, "labels_list", None)
+        options = {name: value for name, value in kwargs.items() if name not in ("verbose", "silent", "no_cache")}
+        key = feature_key(type(self).__name__, tokenizer_name, self.args.max_seq_length, labels,
+                          dataset_hash(examples) + repr((args, sorted(options.items()))))
+        path = Path(self.feature_cache_dir) / key
+        if path.exists():
+            return arrays_dataset(load_arrays(path))
+
+        dataset = super().load_and_cache_examples(examples, *args, **kwargs)
+        arrays = dataset_arrays(dataset)
+        if arrays is not None: # lazy loading and sliding window evaluation are left uncached
+            path.parent.mkdir(parents=True, exist_ok=True)
+            save_arrays(path, arrays)
+        return dataset
+
+
+class CachedNERModel(FeatureCacheMixin, NERModel):
+    pass
+
+
+class CachedClassificationModel(FeatureCacheMixin, ClassificationModel):
+    pass
+
+
+@click.command()
+@click.argument('paths', type=click.Path(exists=True), nargs=-1, required=True)
+def main(paths):
+    for path in paths:
+        print(path, dataset_hash(dataset.load(path)))
+
+
+if __name__ == "__main__":
+    main()
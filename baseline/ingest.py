@@ -1,75 +1,142 @@
 import pymongo
+import numpy as np
 import pandas as pd
 import spacy
 from tqdm import tqdm
 from collections import defaultdict
-from itertools import combinations, product, zip_longest
-import pickle
 from pprint import pprint 
-
-nlp = spacy.load('en_core_web_sm')
+from pathlib import Path
+from multiprocessing import Pool
+import queue
+import threading
+import hashlib
+import json
+import os
+import click
+import dataset
+
+# only tokens and sentences (from the parser) are used, so skip the rest of the pipeline
+nlp = spacy.load('en_core_web_sm', disable=["tagger", "attribute_ruler", "lemmatizer", "ner"])
 client = pymongo.MongoClient("localhost", 27017)
 db = client.r21
 documents = db["documents"]
 
-# Build a ML-ready DF for a single document, with columns representing tokens, the token position, and their associated labels
-def spans(doc, simple=True):
-    tokens = nlp(doc["text"])  # Extract tokens
-    sents = tokens.sents
-    with tokens.retokenize() as retokenizer:
-        for index, tok in enumerate(tokens):  # treat special cases (deidentified) as single tokens
-            if tok.text == "<" and tokens[index + 2].text == ">":
-                retokenizer.merge(tokens[index:index + 3])
-            elif tok.text == "<" and tokens[index + 3].text == ">" and tokens[index + 2].text == "number":
-                retokenizer.merge(tokens[index:index + 4])
+def entity_label(entity, simple=True) -> str:
+    """
+    label of an entity, with its attributes appended unless simple
+    """
+    entity_type = entity["entity_type"]
+
+    if not simple: # Otherwise add attributes to entities
+        if entity_type == 'symptom':
+            if entity['negation']:
+                entity_type += '+neg'
+            if entity['not_current_symptom']:
+                entity_type += '+not_current_symptom'
+        elif entity_type == 'temporal_frame':
+            try:
+                entity_type += '_' + entity['temporal_type']
+            except TypeError:
+                pass
+        elif entity_type == 'event':
+            try:
+                entity_type += '_' + entity['event_type']
+            except TypeError:
+                pass
+            if entity['childhood_trauma']:
+                entity_type += '+childhood'
+        elif entity_type == 'perpetrator':
+            try:
+                entity_type += '_' + entity['perpetrator_type']
+            except TypeError:
+                pass
+    return entity_type
+
+
+def label_tokens(positions: np.ndarray, ann_entities: dict, simple=True) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Aligns entity spans to tokens, given the sorted character offset of each token.
 
-    df = pd.DataFrame({"token": [tok.text for tok in tokens],
-                        "sentence_id": [i for i,s in enumerate(sents) for _ in range(len(s))],
-                        "entity_id": [None for _ in tokens],
-                       "position": [int(tok.idx) for tok in tokens],
-                       "labels": ["O" for _ in tokens]})
-    for entity_id, entity in doc['ann_entities'].items():
+    A span labels the token starting exactly at its start offset and every following token
+    starting before its end offset. Spans that don't start on a token are dropped, and later
+    entities overwrite earlier ones where they overlap.
+
+    returns the labels and entity ids of every token
+    """
+    starts, ends, span_labels, span_ids = [], [], [], []
+    for entity_id, entity in ann_entities.items():
         try:
             entity_span = entity["indexes"]  # [['5606','5620']]
         except:
             pprint(entity)
             raise ValueError
-        entity_type = entity["entity_type"]
-
-        if not simple: # Otherwise add attributes to entities
-            if entity_type == 'symptom':
-                if entity['negation']:
-                    entity_type += '+neg'
-                if entity['not_current_symptom']:
-                    entity_type += '+not_current_symptom'
-            elif entity_type == 'temporal_frame':
-                try:
-                    entity_type += '_' + entity['temporal_type']
-                except TypeError:
-                    pass
-            elif entity_type == 'event':
-                try:
-                    entity_type += '_' + entity['event_type']
-                except TypeError:
-                    pass
-                if entity['childhood_trauma']:
-                    entity_type += '+childhood'
-            elif entity_type == 'perpetrator':
-                try:
-                    entity_type += '_' + entity['perpetrator_type']
-                except TypeError:
-                    pass
+        entity_type = entity_label(entity, simple)
         for span in entity_span:
+            starts.append(int(span[0]))
+            ends.append(int(span[1]))
+            span_labels.append(entity_type)
+            span_ids.append(entity_id)
+
+    labels = np.full(len(positions), "O", dtype=object)
+    entity_ids = np.full(len(positions), None, dtype=object)
+    if not starts:
+        return labels, entity_ids
+
+    starts = np.array(starts, dtype=np.int64)
+    first = np.searchsorted(positions, starts, side="left")
+    last = np.searchsorted(positions, np.array(ends, dtype=np.int64), side="left")
+    on_token = first < len(positions)
+    on_token[on_token] = positions[first[on_token]] == starts[on_token]
 
-            for index in df.index:  # iterate through df rows
+    for i in np.flatnonzero(on_token):  # in order, so overlaps resolve like they always have
+        labels[first[i]:last[i]] = span_labels[i]
+        entity_ids[first[i]:last[i]] = span_ids[i]
+    return labels, entity_ids
 
-                if df.loc[index, "position"] == int(span[0]):
-                    k = 0
-                    nrows = df.shape[0]
-                    while k <= nrows and df.loc[index + k, "position"] < int(span[1]):
-                        df.at[index + k, "labels"] = entity_type
-                        df.at[index+k, "entity_id"] = entity_id
-                        k += 1
+
+def merge_deidentified(tokens):
+    """
+    treat special cases (deidentified, e.g. <name> or <phone number>) as single tokens, in place
+    """
+    with tokens.retokenize() as retokenizer:
+        for index, tok in enumerate(tokens):
+            if tok.text == "<" and tokens[index + 2].text == ">":
+                retokenizer.merge(tokens[index:index + 3])
+            elif tok.text == "<" and tokens[index + 3].text == ">" and tokens[index + 2].text == "number":
+                retokenizer.merge(tokens[index:index + 4])
+    return tokens
+
+
+def parse(doc):
+    return merge_deidentified(nlp(doc["text"]))
+
+
+def parse_documents(docs, batch_size=64, n_process=1):
+    """
+    Streams (doc, parsed tokens) pairs, parsing the texts in batches through nlp.pipe,
+    with n_process worker processes
+    """
+    pairs = ((doc["text"], doc) for doc in docs)
+    for tokens, doc in nlp.pipe(pairs, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield doc, merge_deidentified(tokens)
+
+
+# Build a ML-ready DF for a single document, with columns representing tokens, the token position, and their associated labels
+def spans(doc, simple=True, tokens=None):
+    """
+    tokens: doc["text"] already run through parse, so it can be shared with build_relation_df
+    """
+    if tokens is None:
+        tokens = parse(doc)  # Extract tokens
+
+    positions = np.fromiter((tok.idx for tok in tokens), dtype=np.int64, count=len(tokens))
+    labels, entity_ids = label_tokens(positions, doc['ann_entities'], simple)
+
+    df = pd.DataFrame({"token": [tok.text for tok in tokens],
+                        "sentence_id": [i for i,s in enumerate(tokens.sents) for _ in range(len(s))],
+                        "entity_id": entity_ids,
+                       "position": positions,
+                       "labels": labels})
     return df
 
 
@@ -84,55 +151,115 @@ def simplify_label(label: str) -> str:
     return label
 
 
-def relation_combination(sentence_text, entities):
-    types = defaultdict(list)
-    if len(entities) < 2: 
-        return pd.DataFrame([], columns=["e1","e2","sentence_text"])
+# candidate relations, as (name, label of e1, label of e2), in the order they're listed for a sentence
+CANDIDATE_TYPES = [("perpetrated_by", "event", "perpetrator"), ("subevents", "event", "event"), ("grounded_to", "event", "temporal_frame")]
+ENTITY_CODES = {"event": 0, "perpetrator": 1, "temporal_frame": 2} # simplified labels that take part in candidates
+
+
+def relation_candidates(sentence_ids: np.ndarray, types: np.ndarray, entities: np.ndarray, window: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    All candidate pairs among entity occurrences, in one go over whole arrays rather than sentence by sentence.
+
+    sentence_ids: sentence of each occurrence, ascending (an entity across two sentences occurs in both)
+    types: ENTITY_CODES code of each occurrence's simplified label, -1 for the rest
+    entities: int id of each occurrence's entity, an entity isn't its own subevent
+    window: also pair occurrences up to window sentences apart, 0 keeps pairs within a sentence
+
+    returns the occurrence indexes of e1 and e2 and the CANDIDATE_TYPES index of every pair, by sentence of e1,
+    then candidate type, then occurrence order (the order relation_combination lists them for one sentence)
+    """
+    n = len(sentence_ids)
+    lo = np.searchsorted(sentence_ids, sentence_ids - window, side="left")
+    hi = np.searchsorted(sentence_ids, sentence_ids + window, side="right")
+    counts = hi - lo
+    # every occurrence against every occurrence of its window: e2 runs from lo to hi for each e1
+    e1 = np.repeat(np.arange(n), counts)
+    e2 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
 
-    for entity_id, label in entities: # sort entities base on type
-        types[label].append(entity_id)
+    kinds = np.full(len(e1), -1, dtype=np.int8)
+    for kind, (_, label1, label2) in enumerate(CANDIDATE_TYPES):
+        kinds[(types[e1] == ENTITY_CODES[label1]) & (types[e2] == ENTITY_CODES[label2])] = kind
+    keep = (kinds >= 0) & (entities[e1] != entities[e2])
+    e1, e2, kinds = e1[keep], e2[keep], kinds[keep]
 
-    perpetrated_by = list(product(types["event"], types["perpetrator"]))
-    subevents = product(types['event'], types["event"])
-    subevents = [(a,b) for a,b in subevents if a != b]
-    grounded_to = list(product(types["event"], types["temporal_frame"]))  # updated annotation guidelines only uses events
+    order = np.lexsort((kinds, sentence_ids[e1])) # stable, so occurrence order within each
+    return e1[order], e2[order], kinds[order]
 
-    relations = perpetrated_by + subevents + grounded_to
-    relations = [(a,b,str(sentence_text)) for a,b in relations]
-    return pd.DataFrame(relations, columns = ["e1","e2","sentence_text"])
 
+def relation_combination(sentence_text, entities):
+    """
+    candidate relations of one sentence, entities being (entity id, simplified label) pairs
+    """
+    entities = list(entities)
+    if len(entities) < 2: 
+        return pd.DataFrame([], columns=["e1","e2","sentence_text"])
 
+    ids = np.array([entity_id for entity_id, _ in entities], dtype=object)
+    types = np.array([ENTITY_CODES.get(label, -1) for _, label in entities])
+    e1, e2, _ = relation_candidates(np.zeros(len(ids), dtype=np.int64), types, pd.factorize(ids)[0])
+    return pd.DataFrame({"e1": ids[e1], "e2": ids[e2], "sentence_text": str(sentence_text)}, columns=["e1","e2","sentence_text"])
 
 
-def build_relation_df(span_df: pd.DataFrame, doc):
-    sentence_entities = defaultdict(set) # key is sentence ID, val is list of entities in that sentence
-    relation_df = pd.DataFrame([], columns=["e1","e2"])
-    sents = list(nlp(doc["text"]).sents)
-    for _, row in span_df.iterrows(): #iterating by token
-        if row["entity_id"]:
-            # for each sentence, make a list of all the entities with their ids and types
-            sentence_entities[sents[row["sentence_id"]]].add((row["entity_id"], simplify_label(row["labels"])))
+def relation_pairs(span_df: pd.DataFrame, sents: list[str], window=0) -> tuple[np.ndarray, np.ndarray, list[str], np.ndarray]:
+    """
+    candidate pairs among the entities of a document's span_df (entity_id, sentence_id, labels), sents being the
+    text of its sentences
 
-    # build out relation_df by sentence
-    for sentence_text, entities in sentence_entities.items():
-        df = relation_combination(sentence_text,entities) # all possible relations for this sentence
-        relation_df = pd.concat([relation_df, df], ignore_index=True)
+    returns the entity ids of e1 and e2, the sentence_text and the CANDIDATE_TYPES index of every pair
+    """
+    # each entity once per sentence it's in, at its first token there (straight on the arrays, pandas
+    # indexing costs more than the work for a document's worth of rows)
+    entity_column = span_df["entity_id"].to_numpy(dtype=object)
+    sentence_column = span_df["sentence_id"].to_numpy(dtype=np.int64)
+    rows = np.flatnonzero(pd.notna(entity_column))
+    first_rows = {}
+    for row, key in zip(rows.tolist(), zip(sentence_column[rows].tolist(), entity_column[rows].tolist())):
+        first_rows.setdefault(key, row)
+    rows = np.fromiter(first_rows.values(), dtype=np.int64, count=len(first_rows))
+
+    labels = span_df["labels"].to_numpy(dtype=object)[rows]
+    codes = {label: ENTITY_CODES.get(simplify_label(label), -1) for label in set(labels.tolist())}
+    sentence_ids = sentence_column[rows]
+    entity_ids = entity_column[rows]
+    entity_codes = pd.factorize(entity_ids)[0]
+    e1, e2, kinds = relation_candidates(sentence_ids, np.array([codes[label] for label in labels], dtype=np.int64),
+                                        entity_codes, window)
+
+    # an entity across sentences occurs in each, so the same two entities can pair more than once: keep the pair
+    # closest together, in candidate order
+    pairs = entity_codes[e1].astype(np.int64) * len(entity_ids) + entity_codes[e2]
+    by_distance = np.argsort(np.abs(sentence_ids[e1] - sentence_ids[e2]), kind="stable")
+    keep = np.sort(by_distance[np.unique(pairs[by_distance], return_index=True)[1]])
+    e1, e2, kinds = e1[keep], e2[keep], kinds[keep]
+
+    first = np.minimum(sentence_ids[e1], sentence_ids[e2])
+    last = np.maximum(sentence_ids[e1], sentence_ids[e2])
+    sentence_text = [sents[a] if a == b else " ".join(sents[a:b + 1]) for a, b in zip(first.tolist(), last.tolist())]
+    return entity_ids[e1], entity_ids[e2], sentence_text, kinds
+
+
+def build_relation_df(span_df: pd.DataFrame, doc, tokens=None, window=0):
+    """
+    tokens: the same parse span_df was built from, parsed again if not given
+    window: see relation_candidates, the sentence_text of a pair across sentences spans all of them
+    """
+    if tokens is None:
+        tokens = parse(doc)
+    e1_ids, e2_ids, sentence_text, kinds = relation_pairs(span_df, [sent.text for sent in tokens.sents], window)
 
     # Make dict of true relations mapping to their relation type
     true_relations = {}
     for _,relation in doc["ann_relations"].items():
         true_relations[(relation["arg1_id"],relation["arg2_id"])] = relation["relation_type"]
+    pairs = zip(e1_ids.tolist(), e2_ids.tolist())
 
-    # add labels 
-    labels = []
-    for _, row in relation_df.iterrows():
-        labels.append(true_relations.get((row["e1"], row["e2"]), "no_relation"))
-    relation_df["labels"] = labels
-
-    relation_df["e1"] = [doc["ann_entities"][e]["text"] for e in relation_df["e1"]]
-    relation_df["e2"] = [doc["ann_entities"][e]["text"] for e in relation_df["e2"]]
-
-    return relation_df
+    texts = {entity_id: entity["text"] for entity_id, entity in doc["ann_entities"].items()}
+    return pd.DataFrame({"e1": [texts[e] for e in e1_ids],
+                         "e2": [texts[e] for e in e2_ids],
+                         "sentence_text": sentence_text,
+                         "labels": [true_relations.get(pair, "no_relation") for pair in pairs],
+                         "candidate": np.array([name for name, _, _ in CANDIDATE_TYPES], dtype=object)[kinds]},
+                        columns=["e1", "e2", "sentence_text", "labels", "candidate"])
 
 # Not currently using, since we don't really need BIO encoding
 def BIO_labels(labels):
@@ -149,40 +276,253 @@ def BIO_labels(labels):
 
 # Make sentence IDs collection level, rather than document level
 def build_df(df_spans):
-    kounter = 0
-    prev = 0
-    for index, row in df_spans.iterrows():
-        current = df_spans.loc[index,"sentence_id"]
-        if current != prev:
-            prev = current
-            kounter += 1
-        df_spans.loc[index,"sentence_id"] = kounter
+    """
+    a new sentence starts wherever sentence_id differs from the row before (the first row counts as coming after sentence 0)
+    """
+    if df_spans.empty:
+        return df_spans
+    sentence_ids = df_spans["sentence_id"].to_numpy()
+    changed = sentence_ids != np.concatenate(([0], sentence_ids[:-1]))
+    df_spans["sentence_id"] = np.cumsum(changed)
     return df_spans
 
 # Processes a single document (useful for testing)
 def singleton():
     doc = documents.find_one()
-    spans_df = spans(doc, simple=False)
-    return build_df(spans_df), build_relation_df(spans_df,doc)
-
-
-def full_dataset():
-    combined_spans = pd.DataFrame()
-    combined_relations = pd.DataFrame()
-    for doc in tqdm(documents.find(), total=documents.count_documents({}), desc="Ingesting Documents"):
-        spans_df = spans(doc, simple=True)
-        relations_df = build_relation_df(spans_df,doc)
-        combined_relations = pd.concat([combined_relations,relations_df], ignore_index=True)
-        combined_spans = pd.concat([combined_spans, spans_df], ignore_index=True)
+    tokens = parse(doc)
+    spans_df = spans(doc, simple=False, tokens=tokens)
+    return build_df(spans_df), build_relation_df(spans_df, doc, tokens)
+
+
+def ingest_documents(docs, batch_size=64, n_process=1, progress=False, total=None, window=0):
+    """
+    spans and relations of docs, with document level sentence ids (see build_df)
+
+    batch_size, n_process: passed on to nlp.pipe
+    window: sentences apart relation candidates can be, see relation_candidates
+    """
+    span_dfs = [pd.DataFrame()]
+    relation_dfs = [pd.DataFrame()]
+    parsed = parse_documents(docs, batch_size=batch_size, n_process=n_process)
+    for doc, tokens in tqdm(parsed, total=total, desc="Ingesting Documents", disable=not progress):
+        spans_df = spans(doc, simple=True, tokens=tokens)
+        relation_dfs.append(build_relation_df(spans_df, doc, tokens, window))
+        span_dfs.append(spans_df)
+    # concatenate once at the end, concatenating as we go copies everything so far for every document
+    return pd.concat(span_dfs, ignore_index=True), pd.concat(relation_dfs, ignore_index=True)
+
+
+def full_dataset(batch_size=64, n_process=1, collection=documents, window=0):
+    """
+    documents in _id order (the _id index, no sort in memory), as sharded_dataset has them
+
+    batch_size, n_process: passed on to nlp.pipe
+    window: see relation_candidates
+    """
+    combined_spans, combined_relations = ingest_documents(collection.find().sort("_id", 1), batch_size, n_process,
+                                                          progress=True, total=collection.count_documents({}), window=window)
     return build_df(combined_spans), combined_relations
 
 
+# Sharded ingestion: the collection is split into _id ranges, each fetched by its own thread
+# while a process pool does the spaCy work on the batches already fetched
+PROJECTION = {"text": 1, "ann_entities": 1, "ann_relations": 1}
 
-if __name__ == "__main__":
-    spans, relations = full_dataset()
-    spans.to_pickle("spans.pkl")
 
-    # relations.to_pickle("relations.pkl")
+def shard_bounds(collection, n_shards):
+    """
+    Splits the collection into up to n_shards _id ranges of about the same number of documents,
+    as (lower, upper) pairs, lower inclusive, upper exclusive, None meaning unbounded
+    """
+    n_docs = collection.count_documents({})
+    cuts = []
+    for k in range(1, n_shards):
+        cut = next(collection.find({}, {"_id": 1}).sort("_id", 1).skip(k * n_docs // n_shards).limit(1), None)
+        if cut is not None and (not cuts or cut["_id"] != cuts[-1]):
+            cuts.append(cut["_id"])
+    bounds = [None] + cuts + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_filter(lower, upper):
+    id_range = {}
+    if lower is not None:
+        id_range["$gte"] = lower
+    if upper is not None:
+        id_range["$lt"] = upper
+    return {"_id": id_range} if id_range else {}
+
+
+def fetch_shard(collection, shard, bounds, batch_size, fetched: queue.Queue):
+    """
+    Puts (shard, batch of documents) on fetched, in _id order, then (shard, None) once the shard is done.
+    fetched is bounded, so this blocks while the pool is behind.
+    """
+    try:
+        batch = []
+        for doc in collection.find(shard_filter(*bounds), PROJECTION, batch_size=batch_size).sort("_id", 1):
+            batch.append(doc)
+            if len(batch) == batch_size:
+                fetched.put((shard, batch))
+                batch = []
+        if batch:
+            fetched.put((shard, batch))
+        fetched.put((shard, None))
+    except Exception as e:
+        fetched.put((shard, e))
+
+
+def ingest_batch(task):
+    shard, batch, window = task
+    if batch is None:  # end of shard marker
+        return shard, 0, None, None
+    return (shard, len(batch), *ingest_documents(batch, batch_size=len(batch), window=window))
+
+
+def sharded_dataset(out_dir="shards", n_shards=8, n_process=4, batch_size=256, prefetch=8, collection=documents, window=0):
+    """
+    Same output as full_dataset (documents in _id order), with fetching and parsing overlapped.
+
+    Each shard's spans and relations go to their own pickles in out_dir as soon as the shard is
+    done, and those are merged at the end.
+
+    n_shards: number of _id ranges, each fetched by its own thread
+    n_process: number of processes doing the spaCy work
+    batch_size: documents per Mongo round trip, and per task sent to the pool
+    prefetch: batches fetched or in the pool at most, bounds memory
+    window: see relation_candidates
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    bounds = shard_bounds(collection, n_shards)
+
+    fetched = queue.Queue(maxsize=prefetch)
+    pending = threading.Semaphore(prefetch)  # keeps the fetchers from running ahead of the pool
+    stopped = threading.Event()
+    fetchers = [threading.Thread(target=fetch_shard, args=(collection, shard, shard_range, batch_size, fetched), daemon=True)
+                for shard, shard_range in enumerate(bounds)]
+    for fetcher in fetchers:
+        fetcher.start()
+
+    def batches():
+        remaining = len(bounds)
+        while remaining:
+            shard, batch = fetched.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if batch is None:
+                remaining -= 1
+            pending.acquire()
+            if stopped.is_set():
+                return
+            yield shard, batch, window
+
+    shard_spans = defaultdict(lambda: [pd.DataFrame()])
+    shard_relations = defaultdict(lambda: [pd.DataFrame()])
+    total = collection.count_documents({})
+    with Pool(n_process) as pool, tqdm(total=total, desc="Ingesting Documents") as progress:
+        try:
+            # imap keeps submission order, so a shard's end marker comes back after all its batches
+            for shard, n_docs, spans_df, relations_df in pool.imap(ingest_batch, batches()):
+                pending.release()
+                if spans_df is None:
+                    pd.concat(shard_spans.pop(shard, [pd.DataFrame()]), ignore_index=True).to_pickle(out_dir / f"spans-{shard:03d}.pkl")
+                    pd.concat(shard_relations.pop(shard, [pd.DataFrame()]), ignore_index=True).to_pickle(out_dir / f"relations-{shard:03d}.pkl")
+                    continue
+                shard_spans[shard].append(spans_df)
+                shard_relations[shard].append(relations_df)
+                progress.update(n_docs)
+        finally:
+            stopped.set()
+            pending.release(prefetch)  # unblock batches() so the pool can shut down
+
+    combined_spans = pd.concat([pd.read_pickle(out_dir / f"spans-{shard:03d}.pkl") for shard in range(len(bounds))], ignore_index=True)
+    combined_relations = pd.concat([pd.read_pickle(out_dir / f"relations-{shard:03d}.pkl") for shard in range(len(bounds))], ignore_index=True)
+    return build_df(combined_spans), combined_relations
+
+
+# Incremental ingestion: each document's spans and relations are cached under a fingerprint of
+# its content, so a rerun only parses documents that were added or re-annotated since the last one
+INGEST_CACHE_VERSION = 2  # bump when spans or build_relation_df change what they output
+
+
+def document_fingerprint(doc, window=0) -> str:
+    content = json.dumps([INGEST_CACHE_VERSION, window, doc["text"], doc["ann_entities"], doc["ann_relations"]], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def incremental_dataset(cache_dir="ingest_cache", batch_size=64, n_process=1, collection=documents, window=0):
+    """
+    Same output as full_dataset, reusing the per document outputs cached in cache_dir by earlier runs.
+
+    cache_dir/parts holds one pickle of (spans, relations) per fingerprint, and cache_dir/index.pkl
+    maps each _id to its fingerprint at the last run, to tell added, changed and deleted documents apart.
+    Parts no longer used by any document are deleted.
+    """
+    cache_dir = Path(cache_dir)
+    parts = cache_dir / "parts"
+    parts.mkdir(parents=True, exist_ok=True)
+    index_path = cache_dir / "index.pkl"
+    previous = pd.read_pickle(index_path) if index_path.exists() else {}
+
+    current = {}  # _id -> fingerprint, in _id order
+
+    def uncached():
+        for doc in collection.find({}, PROJECTION).sort("_id", 1): # the order full_dataset has them in
+            fingerprint = document_fingerprint(doc, window)
+            current[str(doc["_id"])] = fingerprint
+            if not (parts / f"{fingerprint}.pkl").exists():
+                yield doc
+
+    parsed = parse_documents(uncached(), batch_size=batch_size, n_process=n_process)
+    for doc, tokens in tqdm(parsed, desc="Ingesting changed documents"):
+        spans_df = spans(doc, simple=True, tokens=tokens)
+        relations_df = build_relation_df(spans_df, doc, tokens, window)
+        part_path = parts / f"{current[str(doc['_id'])]}.pkl"
+        tmp_path = part_path.with_name(part_path.name + ".tmp")
+        pd.to_pickle((spans_df, relations_df), tmp_path)
+        os.replace(tmp_path, part_path)
+
+    span_dfs = [pd.DataFrame()]
+    relation_dfs = [pd.DataFrame()]
+    for fingerprint in current.values():
+        spans_df, relations_df = pd.read_pickle(parts / f"{fingerprint}.pkl")
+        span_dfs.append(spans_df)
+        relation_dfs.append(relations_df)
+
+    used = set(current.values())
+    for part_path in parts.glob("*.pkl"):
+        if part_path.stem not in used:
+            part_path.unlink()
+    pd.to_pickle(current, index_path)
+
+    added = current.keys() - previous.keys()
+    deleted = previous.keys() - current.keys()
+    changed = [doc_id for doc_id in current.keys() & previous.keys() if current[doc_id] != previous[doc_id]]
+    print(f"{len(added)} added, {len(changed)} changed, {len(deleted)} deleted, {len(current) - len(added) - len(changed)} unchanged")
+
+    return build_df(pd.concat(span_dfs, ignore_index=True)), pd.concat(relation_dfs, ignore_index=True)
+
+
+@click.command()
+@click.option('--mode', type=click.Choice(["full", "sharded", "incremental"]), default="full",
+              help="full: one pass over the collection, sharded: see sharded_dataset, incremental: see incremental_dataset")
+@click.option('--cache_dir', type=click.Path(), default="ingest_cache", help="incremental mode's cache, sharded mode's shard files")
+@click.option('--n_process', type=int, default=1)
+@click.option('--window', type=int, default=0, help="also make relation candidates between entities up to this many sentences apart")
+def main(mode, cache_dir, n_process, window):
+    if mode == "sharded":
+        spans_df, relations_df = sharded_dataset(out_dir=cache_dir, n_process=n_process, window=window)
+    elif mode == "incremental":
+        spans_df, relations_df = incremental_dataset(cache_dir=cache_dir, n_process=n_process, window=window)
+    else:
+        spans_df, relations_df = full_dataset(n_process=n_process, window=window)
+    dataset.write(spans_df, "spans.parquet")
+    dataset.write(relations_df, "relations.parquet")
 
     # entities = {("T1","event"), ("T2","event"), ("T3","event"), ("T4","event"),("T5","perpetrator")}
     # df = relation_combination("Says she is used to be the one who is being kicked--is being emotionally abused by family.", entities)
+
+
+if __name__ == "__main__":
+    main()
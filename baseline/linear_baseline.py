@@ -0,0 +1,193 @@
+"""
+CPU baseline for the spans and relations datasets of ingest.py: linear models over hashed sparse features, which
+train in minutes without a GPU, next to the roberta models of train.py and train_relations.py.
+
+    TokenTagger, a linear SVM (SGD) labeling each token from the token, its prefix, suffix and shape, and the
+        two tokens either side of it in its sentence
+    RelationClassifier, logistic regression over a candidate's type, the words of e1 and e2, and the words between
+        them in sentence_text
+
+Features are hashed (no vocabulary to fit or store). Token features are computed once per distinct token and
+gathered, so the cost is in the vocabulary rather than the corpus. Both report macro f1, precision and recall, as
+relations_test.py does (token scores leave out "O"). The fitted models are pickled to --output.
+
+python linear_baseline.py --spans annotation_data.parquet --relations relations.parquet
+"""
+
+import pickle
+import re
+import time
+from pathlib import Path
+from pprint import pprint
+import click
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import f1_score, precision_score, recall_score
+
+import dataset
+import split
+
+SALT = np.uint64(0x9E3779B97F4A7C15) # spreads the hashes of different features of the same string apart
+WORD = re.compile(r"\w+")
+
+
+def string_hashes(values) -> np.ndarray:
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def shifted(hashes: np.ndarray, sentence_ids: np.ndarray, offset: int, pad: np.uint64) -> np.ndarray:
+    """
+    hashes of the token offset places away in the same sentence, pad past either end of it
+    """
+    out = np.full_like(hashes, pad)
+    if offset > 0:
+        out[:-offset] = np.where(sentence_ids[:-offset] == sentence_ids[offset:], hashes[offset:], pad)
+    else:
+        out[-offset:] = np.where(sentence_ids[-offset:] == sentence_ids[:offset], hashes[:offset], pad)
+    return out
+
+
+def hashed_matrix(columns: list[np.ndarray], n_features: int) -> csr_matrix:
+    """
+    one feature per column per row, each column's hashes salted differently, folded into n_features
+    """
+    n = len(columns[0])
+    salts = SALT * np.arange(1, len(columns) + 1, dtype=np.uint64) # wraps around, as hashes do
+    indices = np.empty((n, len(columns)), dtype=np.int64)
+    for j, hashes in enumerate(columns):
+        indices[:, j] = (hashes + salts[j]) % np.uint64(n_features)
+    return csr_matrix((np.ones(indices.size, dtype=np.float32), indices.ravel(), np.arange(0, indices.size + 1, len(columns))),
+                      shape=(n, n_features))
+
+
+def f1(true, pred, labels=None):
+    return f1_score(true, pred, labels=labels, average="macro", zero_division=0)
+def recall(true, pred, labels=None):
+    return recall_score(true, pred, labels=labels, average="macro", zero_division=0)
+def precision(true, pred, labels=None):
+    return precision_score(true, pred, labels=labels, average="macro", zero_division=0)
+
+
+def scores(true, pred, labels=None) -> dict:
+    return {"f1_score": f1(true, pred, labels), "precision": precision(true, pred, labels), "recall": recall(true, pred, labels)}
+
+
+class TokenTagger:
+    """
+    labels the tokens of a spans frame (token, sentence_id, rows of a sentence together and in order)
+    """
+    def __init__(self, n_features: int = 2**20, alpha: float = 1e-6, epochs: int = 10, seed: int = 0):
+        self.n_features = n_features
+        self.model = SGDClassifier(loss="hinge", alpha=alpha, max_iter=epochs, tol=None, average=True, random_state=seed)
+
+    def features(self, df: pd.DataFrame) -> csr_matrix:
+        codes, vocabulary = pd.factorize(df["token"].astype(str))
+        words = pd.Series(np.asarray(vocabulary, dtype=object))
+        lower = words.str.lower()
+        shape = words.str.replace(r"[A-Z]", "X", regex=True).str.replace(r"[a-z]", "x", regex=True).str.replace(r"\d", "d", regex=True)
+        shape = shape.str.replace(r"(.)\1\1+", r"\1\1", regex=True) # Xxxxx -> Xxx, so shapes stay few
+
+        word_hashes = {name: string_hashes(values)[codes] for name, values in
+                       (("word", words), ("lower", lower), ("prefix", lower.str[:3]), ("suffix", lower.str[-3:]), ("shape", shape))}
+        sentence_ids = df["sentence_id"].to_numpy(dtype=np.int64)
+        pad = string_hashes(["<pad>"])[0]
+        columns = list(word_hashes.values())
+        for offset in (-2, -1, 1, 2):
+            columns.append(shifted(word_hashes["lower"], sentence_ids, offset, pad))
+        for offset in (-1, 1):
+            columns.append(shifted(word_hashes["shape"], sentence_ids, offset, pad))
+            columns.append(shifted(word_hashes["suffix"], sentence_ids, offset, pad))
+        return hashed_matrix(columns, self.n_features)
+
+    def fit(self, df: pd.DataFrame) -> "TokenTagger":
+        self.model.fit(self.features(df), df["labels"].astype(str).to_numpy())
+        return self
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        return self.model.predict(self.features(df))
+
+
+def relation_features(row: tuple) -> list[str]:
+    e1, e2, sentence_text, candidate = row
+    e1, e2, sentence = e1.lower(), e2.lower(), sentence_text.lower()
+    features = ["candidate=" + candidate]
+    features.extend("e1=" + word for word in WORD.findall(e1))
+    features.extend("e2=" + word for word in WORD.findall(e2))
+    i, j = sentence.find(e1), sentence.find(e2)
+    if i == -1 or j == -1:
+        return features + ["between=unknown"]
+    order = "e1_first" if i <= j else "e2_first"
+    between = WORD.findall(sentence[i + len(e1):j] if i <= j else sentence[j + len(e2):i])
+    distance = len(between)
+    features.append(f"{candidate}/{order}")
+    features.append("distance=" + str(distance if distance < 4 else 4 if distance < 8 else 8 if distance < 16 else 16))
+    features.extend(f"between={word}" for word in between)
+    return features
+
+
+class RelationClassifier:
+    """
+    labels relation candidates (e1, e2, sentence_text and candidate, the type of pair it is, when there is one)
+    """
+    def __init__(self, n_features: int = 2**18, C: float = 1.0):
+        self.hasher = FeatureHasher(n_features=n_features, input_type="string", alternate_sign=False)
+        self.model = LogisticRegression(C=C, max_iter=1000, class_weight="balanced")
+
+    def features(self, df: pd.DataFrame) -> csr_matrix:
+        candidates = df["candidate"].astype(str) if "candidate" in df.columns else pd.Series("", index=df.index)
+        rows = zip(df["e1"].astype(str), df["e2"].astype(str), df["sentence_text"].astype(str), candidates)
+        return self.hasher.transform(relation_features(row) for row in rows)
+
+    def fit(self, df: pd.DataFrame) -> "RelationClassifier":
+        self.model.fit(self.features(df), df["labels"].astype(str).to_numpy())
+        return self
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        return self.model.predict(self.features(df))
+
+
+def evaluate(model, path, columns, output_path, seed: int, labels=None) -> dict:
+    """
+    fits model on the train part of the dataset at path, and scores it on the test part (see split.py)
+    """
+    data = dataset.load(path, columns=columns)
+    train, test = split.train_test(data, test_size=0.3, seed=seed)
+    start = time.perf_counter()
+    model.fit(train)
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    predicted = model.predict(test)
+    predict_time = time.perf_counter() - start
+    true = test["labels"].astype(str).to_numpy()
+    result = scores(true, predicted, labels(true) if labels else None)
+    result.update(train_rows=len(train), test_rows=len(test), fit_seconds=round(fit_time, 1), predict_seconds=round(predict_time, 1))
+    with open(output_path, "wb") as f:
+        pickle.dump(model, f)
+    return result
+
+
+@click.command()
+@click.option('--spans', 'spans_path', type=click.Path(exists=True), default=None, help="spans dataset, for the token tagger")
+@click.option('--relations', 'relations_path', type=click.Path(exists=True), default=None, help="relations dataset, for the relation classifier")
+@click.option('--output', type=click.Path(), default="linear_models", help="directory the fitted models are pickled to")
+@click.option('--seed', type=int, default=0, help="seed of the train/test split")
+def main(spans_path, relations_path, output, seed):
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    if spans_path:
+        print("tokens")
+        pprint(evaluate(TokenTagger(seed=seed), spans_path, ["sentence_id", "token", "labels"], output/"tokens.pkl", seed,
+                        labels=lambda true: sorted(set(true) - {"O"})), width=1)
+    if relations_path:
+        print("relations")
+        pprint(evaluate(RelationClassifier(), relations_path, None, output/"relations.pkl", seed), width=1)
+
+
+if __name__ == "__main__":
+    # from the imported module, so the models pickle as linear_baseline.TokenTagger rather than
+    # __main__.TokenTagger, which serve.py (or anything else) couldn't load
+    import linear_baseline
+    linear_baseline.main()
@@ -0,0 +1,329 @@
+"""
+Runs the sweep in sweep.yaml on one machine, without wandb.
+
+Trials run in parallel worker processes, each in its own output directory (sweeps/<sweep>/trial-0001 ...).
+Parameters are drawn by the sweep's method: grid, random, or bayes (a Tree-structured Parzen Estimator, random
+for the first few trials). The program's run_trial reports every evaluation made during training. A trial that
+falls behind is pruned by asynchronous successive halving (ASHA): at report 1, eta, eta^2 ... it stops unless it's
+in the top 1/eta of the trials that got that far. Trials and reports are kept in a SQLite database, so a sweep can
+be resumed, and looked at with any SQLite client while it runs.
+
+The program (sweep.yaml's program, train.py) has to define
+    run_trial(config: dict, output_dir: str, report) -> dict of final metrics
+with report(metrics) called after each evaluation, which raises Pruned when the trial should stop.
+
+python local_sweep.py sweep.yaml --trials 20 --processes 4
+python local_sweep.py sweep.yaml --trials 10 --prune-metric recall  continues the same sweep with 10 more trials
+"""
+
+import importlib
+import itertools
+import json
+import math
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import time
+import traceback
+from functools import partial
+from multiprocessing import Pool, SimpleQueue, active_children
+from pathlib import Path
+import click
+import numpy as np
+import yaml
+from tqdm import tqdm
+
+POLL_SECONDS = 10  # how often the runner looks for trials whose worker died
+
+SCHEMA = """
+create table if not exists trials (sweep text, trial integer, params text, state text, value real, output_dir text,
+                                   started real, finished real, error text, primary key (sweep, trial));
+create table if not exists reports (sweep text, trial integer, step integer, value real, metrics text,
+                                    primary key (sweep, trial, step));
+"""
+
+
+class Pruned(Exception):
+    pass
+
+
+def connect(db_path) -> sqlite3.Connection:
+    db = sqlite3.connect(db_path, timeout=60)
+    db.execute("pragma journal_mode=wal") # workers write reports while the runner reads
+    db.executescript(SCHEMA)
+    return db
+
+
+# Search space, as in wandb sweep configs: {"values": [...]}, {"value": x} or {"min": a, "max": b}, the last one
+# sampled uniformly (as ints when both are ints), or log uniformly with "distribution": "log_uniform_values"
+
+def is_log(spec: dict) -> bool:
+    return spec.get("distribution") == "log_uniform_values"
+
+
+def is_int(spec: dict) -> bool:
+    return isinstance(spec["min"], int) and isinstance(spec["max"], int)
+
+
+def sample(spec: dict, rng: np.random.Generator):
+    if "value" in spec:
+        return spec["value"]
+    if "values" in spec:
+        return spec["values"][rng.integers(len(spec["values"]))]
+    if is_int(spec):
+        return int(rng.integers(spec["min"], spec["max"] + 1))
+    if is_log(spec):
+        return float(math.exp(rng.uniform(math.log(spec["min"]), math.log(spec["max"]))))
+    return float(rng.uniform(spec["min"], spec["max"]))
+
+
+def grid(parameters: dict) -> list[dict]:
+    names = list(parameters)
+    choices = []
+    for name in names:
+        spec = parameters[name]
+        if "value" not in spec and "values" not in spec:
+            raise ValueError(f"grid search needs values for {name}, not a range")
+        choices.append([spec["value"]] if "value" in spec else spec["values"])
+    return [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+
+
+def suggest_tpe(parameters: dict, history: list[tuple[dict, float]], rng: np.random.Generator, maximize: bool,
+                n_startup: int = 5, n_candidates: int = 24, gamma: float = 0.25) -> dict:
+    """
+    Tree-structured Parzen Estimator: the history (params, value) is split into the best gamma and the rest, and of
+    n_candidates drawn around the best, the one most likely under the best relative to the rest is returned
+    """
+    if len(history) < n_startup:
+        return {name: sample(spec, rng) for name, spec in parameters.items()}
+
+    ranked = sorted(history, key=lambda trial: trial[1], reverse=maximize)
+    n_good = max(1, math.ceil(gamma * len(ranked)))
+    good, bad = [params for params, _ in ranked[:n_good]], [params for params, _ in ranked[n_good:]]
+
+    candidates = [{} for _ in range(n_candidates)]
+    scores = np.zeros(n_candidates)
+    for name, spec in parameters.items():
+        if "value" in spec:
+            for candidate in candidates:
+                candidate[name] = spec["value"]
+            continue
+
+        if "values" in spec:
+            values = spec["values"]
+            def density(observed):
+                counts = np.array([sum(params.get(name) == value for params in observed) for value in values], dtype=float)
+                return (counts + 1) / (counts.sum() + len(values)) # smoothed towards uniform
+            l, g = density(good), density(bad)
+            picks = rng.choice(len(values), size=n_candidates, p=l)
+            for candidate, pick in zip(candidates, picks):
+                candidate[name] = values[pick]
+            scores += np.log(l[picks]) - np.log(g[picks])
+            continue
+
+        # ranges, in log space for log uniform ones
+        to_x = (lambda v: math.log(v)) if is_log(spec) else (lambda v: float(v))
+        low, high = to_x(spec["min"]), to_x(spec["max"])
+        good_x = np.array([to_x(params[name]) for params in good if name in params])
+        bad_x = np.array([to_x(params[name]) for params in bad if name in params])
+        def density(points, x):
+            # a Gaussian around each point plus a uniform prior over the range, counting as one more point
+            if not len(points):
+                return np.full(len(x), 1 / (high - low))
+            bandwidth = max((high - low) * len(points) ** -0.2 / 2, (high - low) / 100)
+            kernels = np.exp(-0.5 * ((x[:, None] - points[None, :]) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi))
+            return (kernels.sum(axis=1) + 1 / (high - low)) / (len(points) + 1)
+        centers = good_x[rng.integers(len(good_x), size=n_candidates)]
+        bandwidth = max((high - low) * len(good_x) ** -0.2 / 2, (high - low) / 100)
+        x = np.clip(rng.normal(centers, bandwidth), low, high)
+        scores += np.log(density(good_x, x)) - np.log(density(bad_x, x))
+        for candidate, value in zip(candidates, x):
+            value = math.exp(value) if is_log(spec) else float(value)
+            candidate[name] = int(round(value)) if is_int(spec) else value
+
+    return candidates[int(np.argmax(scores))]
+
+
+class Reporter:
+    """
+    report of a trial: records the metrics of each evaluation, and raises Pruned at a rung (report min_reports,
+    min_reports * eta, min_reports * eta^2 ...) unless the trial is in the top 1/eta of the trials that reached it
+    """
+    def __init__(self, db_path, sweep: str, trial: int, metric: str, maximize: bool, eta: int, min_reports: int):
+        self.db_path, self.sweep, self.trial = db_path, sweep, trial
+        self.metric, self.maximize, self.eta, self.min_reports = metric, maximize, eta, min_reports
+        self.step = 0
+        self.value = None
+
+    def is_rung(self, step: int) -> bool:
+        if not self.eta:
+            return False # pruning off
+        rung = self.min_reports
+        while rung < step:
+            rung *= self.eta
+        return rung == step
+
+    def __call__(self, metrics: dict) -> None:
+        self.step += 1
+        self.value = float(metrics[self.metric])
+        db = connect(self.db_path)
+        try:
+            with db:
+                db.execute("insert or replace into reports values (?, ?, ?, ?, ?)",
+                           (self.sweep, self.trial, self.step, self.value, json.dumps(metrics, default=float)))
+            if not self.is_rung(self.step):
+                return
+            values = [value for value, in db.execute("select value from reports where sweep = ? and step = ?", (self.sweep, self.step))]
+        finally:
+            db.close()
+        if len(values) < self.eta:
+            return # too few trials got this far to compare
+        values.sort(reverse=self.maximize)
+        cutoff = values[max(1, len(values) // self.eta) - 1]
+        if (self.value < cutoff) if self.maximize else (self.value > cutoff):
+            raise Pruned(f"{self.metric} {self.value:.4f} at report {self.step}, the top 1/{self.eta} of {len(values)} trials have {cutoff:.4f}")
+
+
+_started = None  # per worker process, set by init_worker
+
+
+def init_worker(started: SimpleQueue):
+    global _started
+    _started = started
+
+
+def run_trial(task: tuple) -> tuple[int, str, float, str]:
+    """
+    task is (program, trial, params, output_dir, Reporter arguments), returns (trial, state, value, error). The
+    trial and the worker's pid go to the started queue first, so the runner knows which trials a dead worker had
+    """
+    program, trial, params, output_dir, reporter_args = task
+    if _started is not None:
+        _started.put((trial, os.getpid()))
+    reporter = Reporter(*reporter_args)
+    try:
+        if str(Path(program).parent.resolve()) not in sys.path:
+            sys.path.insert(0, str(Path(program).parent.resolve()))
+        module = importlib.import_module(Path(program).stem)
+        result = module.run_trial(params, output_dir, reporter)
+        return trial, "complete", float(result[reporter.metric]), None
+    except Pruned as e:
+        shutil.rmtree(output_dir, ignore_errors=True) # the checkpoints of a pruned trial aren't worth keeping
+        return trial, "pruned", reporter.value, str(e)
+    except Exception:
+        return trial, "failed", reporter.value, traceback.format_exc()
+
+
+@click.command()
+@click.argument('config_path', type=click.Path(exists=True), default="sweep.yaml")
+@click.option('--trials', 'n_trials', type=int, default=20, help="trials to run (grid search stops sooner once the grid is done)")
+@click.option('--processes', type=int, default=None, help="trials run at once, defaults to the number of CPUs")
+@click.option('--name', default=None, help="sweep name, defaults to the config file's name")
+@click.option('--out-dir', type=click.Path(), default="sweeps", help="where trial output directories and sweep.db go")
+@click.option('--prune-metric', default=None, help="metric the trials are pruned on (e.g. recall), defaults to the sweep metric")
+@click.option('--eta', type=int, default=3, help="reduction factor, a trial goes on past a rung if it's in the top 1/eta")
+@click.option('--min-reports', type=int, default=1, help="report of the first rung")
+@click.option('--no-prune', is_flag=True)
+@click.option('--seed', type=int, default=0)
+def main(config_path, n_trials, processes, name, out_dir, prune_metric, eta, min_reports, no_prune, seed):
+    with open(config_path, encoding="utf8") as f:
+        config = yaml.safe_load(f)
+    name = name or Path(config_path).stem
+    program = str(Path(config_path).parent / config.get("program", "train.py"))
+    parameters = config["parameters"]
+    method = config.get("method", "random")
+    metric = config["metric"]["name"]
+    maximize = config["metric"].get("goal", "maximize") == "maximize"
+    prune_metric = prune_metric or metric
+    processes = processes or os.cpu_count()
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    db_path = out_dir / "sweep.db"
+    db = connect(db_path)
+    with db: # a run that died left its trials running
+        db.execute("update trials set state = 'failed', error = 'interrupted' where sweep = ? and state = 'running'", (name,))
+    first_trial = db.execute("select coalesce(max(trial), 0) + 1 from trials where sweep = ?", (name,)).fetchone()[0]
+
+    rng = np.random.default_rng(seed + first_trial)
+    done_params = [json.loads(params) for params, in db.execute("select params from trials where sweep = ?", (name,))]
+    remaining_grid = [params for params in grid(parameters) if params not in done_params] if method == "grid" else None
+
+    def suggest():
+        if method == "grid":
+            return remaining_grid.pop(0) if remaining_grid else None
+        if method == "bayes":
+            # pruned trials count with their last report, when that's the same metric
+            states = "('complete', 'pruned')" if prune_metric == metric else "('complete')"
+            history = db.execute(f"select params, value from trials where sweep = ? and state in {states} and value is not null", (name,))
+            return suggest_tpe(parameters, [(json.loads(params), value) for params, value in history], rng, maximize)
+        return {param: sample(spec, rng) for param, spec in parameters.items()}
+
+    finished = queue.Queue()
+    started = SimpleQueue()
+    running = set()
+    workers = {} # running trial: pid of the worker running it
+    states = {}
+    progress = tqdm(total=n_trials, desc="Trials")
+    # not maxtasksperchild=1: tasks submitted while a worker is being replaced can be lost, and the pool hangs
+    with Pool(processes, initializer=init_worker, initargs=(started,)) as pool:
+        trial = first_trial
+        while trial < first_trial + n_trials or running:
+            while len(running) < processes and trial < first_trial + n_trials:
+                params = suggest()
+                if params is None:
+                    n_trials = trial - first_trial
+                    progress.total = n_trials
+                    break
+                output_dir = out_dir / name / f"trial-{trial:04d}"
+                with db:
+                    db.execute("insert into trials values (?, ?, ?, 'running', null, ?, ?, null, null)",
+                               (name, trial, json.dumps(params), str(output_dir), time.time()))
+                reporter_args = (db_path, name, trial, prune_metric, maximize, 0 if no_prune else eta, min_reports)
+                pool.apply_async(run_trial, ((program, trial, params, str(output_dir), reporter_args),), callback=finished.put,
+                                 error_callback=partial(lambda trial, e: finished.put((trial, "failed", None, repr(e))), trial))
+                running.add(trial)
+                trial += 1
+            if not running:
+                break
+
+            try:
+                finished_trial, state, value, error = finished.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                # a worker killed outright (out of memory, a signal) never returns its trial, the pool just
+                # replaces it, so fail the trials of workers that are gone
+                while not started.empty():
+                    started_trial, pid = started.get()
+                    if started_trial in running:
+                        workers[started_trial] = pid
+                alive = {child.pid for child in active_children()}
+                for lost_trial, pid in list(workers.items()):
+                    if pid not in alive:
+                        finished.put((lost_trial, "failed", None, f"worker {pid} died"))
+                        del workers[lost_trial]
+                continue
+            if finished_trial not in running:
+                continue
+            running.discard(finished_trial)
+            workers.pop(finished_trial, None)
+            states[state] = states.get(state, 0) + 1
+            with db:
+                db.execute("update trials set state = ?, value = ?, finished = ?, error = ? where sweep = ? and trial = ?",
+                           (state, value, time.time(), error, name, finished_trial))
+            progress.update()
+            progress.set_postfix(states)
+    progress.close()
+
+    best = db.execute(f"select trial, params, value from trials where sweep = ? and state = 'complete' order by value {'desc' if maximize else 'asc'} limit 5",
+                      (name,)).fetchall()
+    for trial, params, value in best:
+        print(f"trial {trial}\t{metric} {value:.4f}\t{params}")
+    print(f"{sum(states.values())} trials run: " + ", ".join(f"{state} {count}" for state, count in sorted(states.items()))
+          + f", results in {db_path}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
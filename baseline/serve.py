@@ -0,0 +1,290 @@
+"""
+Annotates notes as they come in, with models loaded once: sentence splitting and tokens (ingest.nlp), entity tagging,
+relation candidates (ingest.relation_pairs, as for the relations dataset) and relation classification. Returns
+BRAT standoff, as entities, relations and the .ann text, whose types are the ones annotation.conf lists.
+
+Notes from any number of clients are gathered into micro batches: a batch goes once it has --max-batch notes, or
+once its first note has waited --max-wait ms (the latency budget), and is sorted by length so the tagger pads
+less. Models are the CPU ones pickled by linear_baseline.py, or a saved simpletransformers NER model (--ner-model).
+
+python serve.py --tokens linear_models/tokens.pkl --relations linear_models/relations.pkl --port 8000
+    POST /annotate {"text": ...} -> {"entities": [...], "relations": [...], "ann": ...}
+python serve.py --tokens linear_models/tokens.pkl --stdin < notes.jsonl > annotations.jsonl
+    one {"id": ..., "text": ...} per line in, one annotation (or error) per line out, in the same order
+"""
+
+import json
+import pickle
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import click
+import numpy as np
+import pandas as pd
+
+from ingest import CANDIDATE_TYPES, parse_documents, relation_pairs, spans
+
+# annotation.conf types of the lowercase labels the models are trained on, others go out as they are
+ENTITY_TYPES = {"symptom": "Symptom", "substance": "Substance", "event": "Event", "perpetrator": "Perpetrator",
+                "temporal_frame": "Temporal_Frame"}
+RELATION_TYPES = {"perpetrated_by": "Perpetrated_By", "grounded_to": "Grounded_To", "sub-event": "Sub-Event", "subevents": "Sub-Event"}
+
+
+class TransformerTagger:
+    """
+    a saved simpletransformers NERModel, with the predict of linear_baseline.TokenTagger
+    """
+    def __init__(self, model_dir: str, model_type: str = "roberta"):
+        from simpletransformers.ner import NERModel
+        self.model = NERModel(model_type, model_dir, use_cuda=False,
+                              args={"silent": True, "use_multiprocessing": False, "use_multiprocessing_for_evaluation": False})
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        sentences = [group.tolist() for _, group in df["token"].astype(str).groupby(df["sentence_id"].to_numpy(), sort=False)]
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i])) # similar lengths share an eval batch
+        predictions, _ = self.model.predict([sentences[i] for i in order], split_on_space=False)
+        labels = [None] * len(sentences)
+        for i, prediction in zip(order, predictions):
+            labels[i] = [label for word in prediction for label in word.values()]
+            labels[i] += ["O"] * (len(sentences[i]) - len(labels[i])) # words past max_seq_length
+        return np.array([label for sentence in labels for label in sentence], dtype=object)
+
+
+def entities(span_df: pd.DataFrame, text: str) -> list[dict]:
+    """
+    runs of tokens of one sentence with the same label, sets span_df's entity_id to the id given to each
+    """
+    labels = span_df["labels"].to_numpy(dtype=object)
+    sentence_ids = span_df["sentence_id"].to_numpy()
+    tagged = labels != "O"
+    starts = tagged & np.concatenate(([True], (labels[1:] != labels[:-1]) | (sentence_ids[1:] != sentence_ids[:-1])))
+    numbers = np.cumsum(starts)
+    span_df["entity_id"] = [f"T{number}" if is_tagged else None for number, is_tagged in zip(numbers.tolist(), tagged.tolist())]
+
+    positions = span_df["position"].to_numpy()
+    token_ends = positions + span_df["token"].astype(str).str.len().to_numpy()
+    found = []
+    for first in np.flatnonzero(starts):
+        last = first
+        while last + 1 < len(labels) and tagged[last + 1] and not starts[last + 1]:
+            last += 1
+        start, end = int(positions[first]), int(token_ends[last])
+        found.append({"id": f"T{numbers[first]}", "type": labels[first], "start": start, "end": end, "text": text[start:end]})
+    return found
+
+
+def to_ann(annotation: dict) -> str:
+    lines = [f"{entity['id']}\t{ENTITY_TYPES.get(entity['type'], entity['type'])} {entity['start']} {entity['end']}\t{entity['text']}"
+             for entity in annotation["entities"]]
+    lines += [f"{relation['id']}\t{RELATION_TYPES.get(relation['type'], relation['type'])} Arg1:{relation['arg1']} Arg2:{relation['arg2']}"
+              for relation in annotation["relations"]]
+    return "".join(line + "\n" for line in lines)
+
+
+class Annotator:
+    """
+    tagger: labels the tokens of a spans frame (linear_baseline.TokenTagger, TransformerTagger)
+    classifier: labels relation candidates (linear_baseline.RelationClassifier), None leaves relations out
+    """
+    def __init__(self, tagger, classifier=None, window: int = 0):
+        self.tagger, self.classifier, self.window = tagger, classifier, window
+
+    def annotate(self, texts: list[str]) -> list[dict]:
+        frames, sentences, offsets = [], [], []
+        offset = 0
+        for doc, tokens in parse_documents(({"text": text} for text in texts), batch_size=max(len(texts), 1)):
+            frame = spans({"ann_entities": {}}, tokens=tokens)
+            frame["sentence_id"] += offset # unique across the batch, so token context stops at the note
+            frames.append(frame)
+            sentences.append([sent.text for sent in tokens.sents])
+            offsets.append(offset)
+            offset += len(sentences[-1])
+
+        batch = pd.concat(frames, ignore_index=True)
+        labels = self.tagger.predict(batch) if len(batch) else np.array([], dtype=object)
+
+        annotations, candidates = [], []
+        start = 0
+        for text, frame, sents, offset in zip(texts, frames, sentences, offsets):
+            frame = frame.assign(labels=labels[start:start + len(frame)], sentence_id=frame["sentence_id"] - offset)
+            start += len(frame)
+            annotations.append({"entities": entities(frame, text), "relations": []})
+            if self.classifier is not None:
+                candidates.append(relation_pairs(frame, sents, self.window))
+
+        if candidates and any(len(e1) for e1, _, _, _ in candidates):
+            texts_by_id = [{entity["id"]: entity["text"] for entity in annotation["entities"]} for annotation in annotations]
+            rows = pd.DataFrame({"e1": [texts_by_id[i][e] for i, (e1, _, _, _) in enumerate(candidates) for e in e1],
+                                 "e2": [texts_by_id[i][e] for i, (_, e2, _, _) in enumerate(candidates) for e in e2],
+                                 "sentence_text": [text for _, _, sentence_text, _ in candidates for text in sentence_text],
+                                 "candidate": np.array([name for name, _, _ in CANDIDATE_TYPES], dtype=object)[
+                                     np.concatenate([kinds for _, _, _, kinds in candidates]).astype(np.int64)]})
+            predicted = iter(self.classifier.predict(rows))
+            for annotation, (e1, e2, _, _) in zip(annotations, candidates):
+                for arg1, arg2 in zip(e1.tolist(), e2.tolist()):
+                    relation_type = next(predicted)
+                    if relation_type != "no_relation":
+                        annotation["relations"].append({"id": f"R{len(annotation['relations']) + 1}", "type": relation_type,
+                                                        "arg1": arg1, "arg2": arg2})
+
+        for annotation in annotations:
+            annotation["ann"] = to_ann(annotation)
+        return annotations
+
+
+class Batcher:
+    """
+    gathers notes submitted from any thread into batches for annotator, run on a thread of its own
+    """
+    def __init__(self, annotator: Annotator, max_batch: int = 16, max_wait: float = 0.05):
+        self.annotator, self.max_batch, self.max_wait = annotator, max_batch, max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self.requests.put((text, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            batch.sort(key=lambda request: len(request[0]))
+            try:
+                results = self.annotator.annotate([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def read_note(line) -> tuple[dict, str]:
+    """
+    (note, error): the JSON object sent in ({} if it isn't one), and an error unless it has a string text
+    """
+    try:
+        note = json.loads(line)
+    except ValueError:
+        note = None
+    if not isinstance(note, dict):
+        return {}, 'expected {"text": ...}'
+    if not isinstance(note.get("text"), str):
+        return note, 'expected {"text": ...}'
+    return note, None
+
+
+def handler(batcher: Batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status: int, body: dict):
+            content = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.reply(200, {"status": "ok"})
+            else:
+                self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/annotate":
+                return self.reply(404, {"error": "not found"})
+            note, error = read_note(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if error is not None:
+                return self.reply(400, {"id": note.get("id"), "error": error})
+            try:
+                result = batcher.submit(note["text"]).result()
+            except Exception as e:
+                return self.reply(500, {"error": repr(e)})
+            self.reply(200, {"id": note.get("id"), **result})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve_stdin(batcher: Batcher, max_pending: int):
+    """
+    annotates JSON lines from stdin, keeping up to max_pending in flight, and writes results in input order
+    """
+    pending = queue.Queue(maxsize=max_pending)
+
+    def write():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            note_id, future = item
+            try:
+                result = {"id": note_id, **future.result()}
+            except Exception as e:
+                result = {"id": note_id, "error": repr(e)}
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            note, error = read_note(line)
+            if error is not None: # answered with an error in its place, like a note that fails
+                rejected = Future()
+                rejected.set_exception(ValueError(error))
+                pending.put((note.get("id"), rejected))
+                continue
+            pending.put((note.get("id"), batcher.submit(note["text"])))
+    finally:
+        pending.put(None) # the writer finishes what's in flight and stops, however reading ended
+        writer.join()
+
+
+@click.command()
+@click.option('--tokens', 'tokens_path', type=click.Path(exists=True), default=None, help="token tagger pickled by linear_baseline.py")
+@click.option('--ner-model', type=click.Path(exists=True), default=None, help="saved simpletransformers NER model directory, instead of --tokens")
+@click.option('--relations', 'relations_path', type=click.Path(exists=True), default=None, help="relation classifier pickled by linear_baseline.py")
+@click.option('--max-batch', type=int, default=16, help="notes per batch at most")
+@click.option('--max-wait', type=float, default=50, help="ms a note waits for others to batch with")
+@click.option('--window', type=int, default=0, help="sentences apart relation candidates can be, see ingest.relation_candidates")
+@click.option('--port', type=int, default=8000)
+@click.option('--stdin', 'use_stdin', is_flag=True, help="read JSON lines from stdin instead of serving HTTP")
+def main(tokens_path, ner_model, relations_path, max_batch, max_wait, window, port, use_stdin):
+    if ner_model:
+        tagger = TransformerTagger(ner_model)
+    elif tokens_path:
+        with open(tokens_path, "rb") as f:
+            tagger = pickle.load(f)
+    else:
+        raise click.UsageError("--tokens or --ner-model is needed")
+    classifier = None
+    if relations_path:
+        with open(relations_path, "rb") as f:
+            classifier = pickle.load(f)
+
+    batcher = Batcher(Annotator(tagger, classifier, window), max_batch=max_batch, max_wait=max_wait / 1000)
+    if use_stdin:
+        serve_stdin(batcher, max_pending=4 * max_batch)
+        return
+    server = ThreadingHTTPServer(("", port), handler(batcher))
+    print(f"serving on port {port}", file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Deterministic train/test and k-fold splits that keep every sentence on one side.
+
+Rows are grouped by the collection level sentence_id (see ingest.build_df), or by sentence_text for relation
+datasets, which have no sentence_id. Groups are shuffled with a seed and cut into folds of about the same number
+of rows. A split is saved as a manifest of index arrays (row order, fold bounds), under splits/, keyed by the
+grouping, the cuts and the seed. The same data and seed give the same split in every run and every sweep trial.
+
+Rows keep their order within a fold. The data is gathered into fold order once, and each fold is a slice of that
+(a view, pandas copies on write).
+
+python split.py spans.parquet --folds 5 --seed 0      writes the manifest and prints the size of each fold
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+
+import dataset
+
+SPLIT_VERSION = 1  # bump when the way groups are assigned to folds changes
+SPLIT_DIR = Path(os.environ.get("SPLIT_DIR", "splits"))
+
+
+def group_codes(df: pd.DataFrame) -> np.ndarray:
+    """
+    the group of each row, rows of a group always end up in the same fold
+    """
+    if "sentence_id" in df.columns:
+        return df["sentence_id"].to_numpy(dtype=np.int64)
+    if isinstance(df["sentence_text"].dtype, pd.CategoricalDtype):
+        return df["sentence_text"].cat.codes.to_numpy(dtype=np.int64)
+    return pd.factorize(df["sentence_text"])[0]
+
+
+def assign_folds(codes: np.ndarray, cuts: list[float], seed: int) -> np.ndarray:
+    """
+    fold of each row. Groups are shuffled, and fold i is the groups starting between cuts[i] and cuts[i + 1] of
+    the way through the shuffled rows (cuts go from 0 to 1)
+    """
+    groups, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    order = np.random.default_rng(seed).permutation(len(groups))
+    starts = np.empty(len(groups))
+    starts[order] = (np.cumsum(counts[order]) - counts[order]) / max(len(codes), 1)
+    return np.searchsorted(np.asarray(cuts[1:-1]), starts, side="right")[inverse]
+
+
+def manifest_key(codes: np.ndarray, cuts: list[float], seed: int) -> str:
+    digest = hashlib.sha256(json.dumps([SPLIT_VERSION, [float(cut) for cut in cuts], seed]).encode("utf8"))
+    digest.update(np.ascontiguousarray(codes).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def manifest(df: pd.DataFrame, cuts: list[float], seed: int = 0, split_dir=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (order, bounds): rows of fold i are order[bounds[i]:bounds[i + 1]], ascending. Loaded from split_dir when
+    it was computed before, written there otherwise
+    """
+    codes = group_codes(df)
+    path = Path(split_dir or SPLIT_DIR) / f"{manifest_key(codes, cuts, seed)}.npz"
+    if path.exists():
+        with np.load(path) as saved:
+            return saved["order"], saved["bounds"]
+
+    folds = assign_folds(codes, cuts, seed)
+    order = np.argsort(folds, kind="stable").astype(np.int32 if len(folds) < 2**31 else np.int64)
+    bounds = np.searchsorted(folds[order], np.arange(len(cuts)))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    try:
+        np.savez(tmp_path, order=order, bounds=bounds, cuts=np.asarray(cuts), seed=seed)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return order, bounds
+
+
+def folds(df: pd.DataFrame, cuts: list[float], seed: int = 0, split_dir=None) -> list[pd.DataFrame]:
+    """
+    df cut into len(cuts) - 1 folds, each a slice of one gathered copy of df
+    """
+    order, bounds = manifest(df, cuts, seed, split_dir)
+    arranged = df.take(order)
+    return [arranged.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def train_test(df: pd.DataFrame, test_size: float = 0.3, seed: int = 0, split_dir=None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    raises ValueError when either side comes out empty, as it does with too few groups (sentences) to cut
+    """
+    test, train = folds(df, [0.0, test_size, 1.0], seed, split_dir)
+    if train.empty or test.empty:
+        raise ValueError(f"too few groups (sentences) to split: {len(np.unique(group_codes(df)))} groups of {len(df)} rows "
+                         f"leave {'train' if train.empty else 'test'} empty with test_size {test_size}")
+    return train, test
+
+
+def k_fold(df: pd.DataFrame, k: int = 5, seed: int = 0, split_dir=None):
+    """
+    yields (train, test) for each of k folds, test being the fold and train the rest
+    """
+    parts = folds(df, list(np.linspace(0.0, 1.0, k + 1)), seed, split_dir)
+    for i, test in enumerate(parts):
+        yield pd.concat(parts[:i] + parts[i + 1:]), test
+
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True), required=True)
+@click.option('--folds', 'k', type=int, default=None, help="k-fold split, instead of train/test")
+@click.option('--test-size', type=float, default=0.3, help="fraction of the rows in the test set")
+@click.option('--seed', type=int, default=0)
+def main(path, k, test_size, seed):
+    df = dataset.load(path)
+    cuts = list(np.linspace(0.0, 1.0, k + 1)) if k else [0.0, test_size, 1.0]
+    order, bounds = manifest(df, cuts, seed)
+    codes = group_codes(df)
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        print(f"fold {i}\t{end - start} rows\t{len(np.unique(codes[order[start:end]]))} groups")
+    print(f"manifest {SPLIT_DIR / manifest_key(codes, cuts, seed)}.npz")
+
+
+if __name__ == "__main__":
+    main()
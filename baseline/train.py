@@ -1,47 +1,88 @@
 import wandb
-from simpletransformers.ner import NERModel, NERArgs
-import pandas as pd
+import torch
+from simpletransformers.ner import NERArgs
+from features import CachedNERModel
 import os
+from pprint import pprint
+import dataset
+import split
 
 
 #os.environ["HTTPS_PROXY"] = "http://micc.tengbenet.cluster:18888"
 
 
-# Get dataset
-data = pd.read_pickle("annotation_data.pkl")
+# Get dataset, NERModel wants the tokens as words
+data = dataset.load("annotation_data.parquet", columns=["sentence_id", "token", "labels"]).rename(columns={"token": "words"})
 
-# Let's just go ahead and make sure this is actually random
-data = data.sample(frac=1)
+# Split into train and test, by sentence, the same way every run (see split.py)
+train, test = split.train_test(data, test_size=0.3, seed=0)
 
-# Split into train and test
-train = data.iloc[:int(0.7 * len(data))]
-test = data.iloc[int(0.7 * len(data)):]
 
 
-
-def main():
-    # Specify labels
-    # Hyperparameters and WandB.....
-
-    wandb.init()
-    config = wandb.config
+def build_args(config: dict) -> NERArgs:
     model_args = NERArgs()
-    model_args.labels_list = list(set(data['labels']))
+    model_args.labels_list = sorted(set(data['labels'])) # sorted, the label ids (and cached features) follow this order
     model_args.use_early_stopping = True
     model_args.early_stopping_delta = 0.01
-    model_args.early_stopping_metric = "mcc"
+    model_args.early_stopping_metric = "f1_score" # NERModel evaluations have no mcc
     model_args.early_stopping_metric_minimize = False
     model_args.early_stopping_patience = 5
     model_args.evaluate_during_training_steps = 1000
     model_args.overwrite_output_dir = True
     model_args.wandb_project = 'R21-Modeling'
-    model_args.update_from_dict(config.__dict__['_items'])
+    model_args.update_from_dict(config)
+    return model_args
+
+
+class ReportingNERModel(CachedNERModel):
+    """
+    calls report with the results of each evaluation made during training, report raising stops the training
+    """
+    report = None
+
+    def eval_model(self, *args, **kwargs):
+        result, model_outputs, preds_list = super().eval_model(*args, **kwargs)
+        if self.report is not None:
+            self.report(result)
+        return result, model_outputs, preds_list
+
+
+def run_trial(config: dict, output_dir: str, report) -> dict:
+    """
+    one trial of local_sweep.py: trains with config, evaluating (and reporting) every epoch on a validation part
+    of train, and returns the metrics on test
+    """
+    fit, validation = split.train_test(train, test_size=0.15, seed=0)
+    model_args = build_args(config)
+    model_args.output_dir = output_dir
+    model_args.best_model_dir = os.path.join(output_dir, "best_model")
+    model_args.evaluate_during_training = True
+    model_args.evaluate_each_epoch = True
+    model_args.wandb_project = None # no network
+    model_args.use_multiprocessing = False # the trials are the processes
+    model_args.use_multiprocessing_for_evaluation = False
+
+    model = ReportingNERModel('roberta', 'roberta-base', args=model_args, use_cuda=torch.cuda.is_available())
+    model.report = report
+    model.train_model(fit, eval_data=validation)
+    model.report = None
+    result, model_outputs, preds_list = model.eval_model(test)
+    return {name: float(value) for name, value in result.items()}
+
+
+def main():
+    # Specify labels
+    # Hyperparameters and WandB.....
+
+    wandb.init()
+    config = wandb.config
+    model_args = build_args(config.__dict__['_items'])
 
     pprint(model_args)
 
     """
-    model = NERModel('roberta', 'roberta-base',
-                     args=model_args, use_cuda=True, cuda_device=1)
+    model = CachedNERModel('roberta', 'roberta-base',
+                           args=model_args, use_cuda=True, cuda_device=1)
     # Train
     model.train_model(train)
     # Test
@@ -3,10 +3,17 @@
 
 import re
 import os
+import pickle
+import hashlib
+import threading
+import time
 from pathlib import Path
 from multiprocessing import Pool
 import click
 from collections import Counter
+from pprint import pprint
+from tqdm import tqdm
+from typing import Iterator, Optional
 
 def star_replace(word: str, first: bool=False, last: bool=False)-> str:
     """
@@ -113,49 +120,246 @@ def expression_to_regex(expression: str) -> str:
     return "".join(expr_list)
 
 
-def annotate(file_path: Path, regexes: list[tuple[re.Pattern,str]], write=True) -> Counter:
+def required_literal(expression: str) -> Optional[str]:
     """
-    Opens the .txt file, and creates and writes to a new .ANN file by running list
-    of regular expressions on each line in .txt file
+    Finds the longest fixed stem that every match of expression has to contain,
+    so a note can be ruled out for that expression without running its regex
+
+    ex:
+        *aggress* -> aggress
+        poor* [0-2_words] sleep* or slep* -> poor
+
+    Returns None when no word in the expression is fixed (only optional words or ORs)
+    """
+    expr_list = expression.split()
+
+    if "or" in expr_list:  # same OR merge as expression_to_regex
+        index = expr_list.index("or")
+        post, prior = expr_list.pop(index+1), expr_list.pop(index-1)
+        expr_list[index-1] = prior + "|" + post
+
+    stems = []
+    for word in expr_list:
+        if "|" in word or word[-6:] == "words]":
+            continue
+        for piece in word.split("*"):
+            if re.fullmatch("[\w/-]*", piece):  # anything else could be a regex metacharacter
+                stems += re.findall("[a-zA-Z0-9]+", piece)
+
+    return max(stems, key=len) if stems else None
+
+
+def trie_regex(literals: list[str]) -> str:
+    """
+    Builds a regex matching any of the literals, factored into a trie so the regex
+    engine compares about one character per position instead of trying every literal.
+    Where one literal is a prefix of another, the longest one is matched.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}  # end of a literal
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        regex = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            regex = "(?:" + regex + ")?"
+        return regex
+
+    return build(trie)
+
+
+class Matcher:
+    """
+    Runs a list of (regex, kind, literal) rules over a note.
+
+    Instead of running every regex over the whole note, one prefilter scan finds which
+    literals (see required_literal) occur in the note, and only the regexes whose literal
+    was found (or that have no literal) are run. Matches come out in the same order as
+    running every regex one after the other, overlaps between rules included.
+    """
+
+    def __init__(self, rules: list[tuple[re.Pattern, str, Optional[str]]]):
+        self.rules = rules
+        self.unfiltered = [i for i, (_, _, literal) in enumerate(rules) if not literal]
+        self.filtered = [i for i, (_, _, literal) in enumerate(rules) if literal]
+
+        # the prefilter reports the longest literal starting at each position, so every
+        # literal inside it (shorter ones starting at the same position included) counts as found
+        literals = {literal.lower() for _, _, literal in rules if literal}
+        self.candidates = {}
+        for literal in literals:
+            self.candidates[literal] = [i for i in self.filtered if rules[i][2].lower() in literal]
+
+        flags = rules[0][0].flags if rules else re.IGNORECASE
+        self.prefilter = re.compile("(?=(" + trie_regex(sorted(literals)) + "))", flags) if literals else None
+
+    def finditer(self, text: str) -> Iterator[tuple[str, re.Match]]:
+        """
+        Yields (kind, match) for every rule that matches text
+        """
+        found = set(self.unfiltered)
+        if self.prefilter:
+            seen = set()
+            for hit in self.prefilter.finditer(text):
+                literal = hit.group(1).lower()
+                if literal in seen:
+                    continue
+                seen.add(literal)
+                # case folding can match characters that don't lower() back to the literal (e.g. the Kelvin sign),
+                # so play it safe and run everything
+                found.update(self.candidates.get(literal, self.filtered))
+
+        for i in sorted(found):
+            regex, kind, _ = self.rules[i]
+            for match in regex.finditer(text):
+                yield kind, match
+
+
+def write_ann(anno_file_path: Path, matches: list[tuple[int, int, str, str]]) -> None:
+    """
+    Writes (start, end, kind, text) matches to a .ann file in one go, numbered in order of offset.
+
+    Writes to a temporary file next to the .ann and renames it over the .ann, so an interrupted
+    run never leaves half a file behind, and a rerun replaces a stale .ann instead of appending to it.
+    """
+    anno_file_path = Path(anno_file_path)
+    lines = [f'T{i}\t{kind} {start} {end}\t{text}\n' for i, (start, end, kind, text) in enumerate(sorted(matches, key=lambda m: m[:2]))]
+
+    tmp_path = anno_file_path.with_name(f"{anno_file_path.name}.{os.getpid()}.tmp")  # pid so parallel runs don't collide
+    try:
+        with open(tmp_path, "w", encoding="utf8") as anno_file:
+            anno_file.writelines(lines)
+        os.replace(tmp_path, anno_file_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def annotate(file_path: Path, matcher: Matcher, write=True) -> Counter:
+    """
+    Opens the .txt file, and creates a new .ANN file (replacing any old one) by running the
+    matcher's regular expressions on the .txt file
 
     returns a counter so you can see stats about what's being annotated, for those with eyes to see
     """
-    anno_file_path =  str(Path(file_path).parent) + os.sep + str(Path(file_path).stem) + ".ann"
+    anno_file_path = Path(file_path).with_suffix(".ann")
     match_count = Counter()
-    _sum = 0
+    matches = []
 
     with Path(file_path).open(encoding="utf8") as ehr_file:
-
         f = ehr_file.read()
-        for regex,kind in regexes:
-            iterator = regex.finditer(f)
-            for match in iterator:
-                start = match.span()[0]
-                end = match.span()[1]
-                if write:
-                    with open(anno_file_path, "a", encoding = "utf8") as anno_file:
-                        anno_file.write(f'T{_sum}\t{kind} {start} {end}\t{match.group()}\n')
-                match_count[kind] += 1
-                _sum += 1
 
-        return match_count
+    for kind, match in matcher.finditer(f):
+        start, end = match.span()
+        matches.append((start, end, kind, match.group()))
+        match_count[kind] += 1
 
+    if write:
+        write_ann(anno_file_path, matches)
+
+    return match_count
 
-def compile_regex_path(regex_path: Path) -> list[re.Pattern]:
-    """
-    Opens the regex_path, translates the regexes into pythonic regexes, and returns
-    a list of compiled regex patterns.
 
-    NOTE: 
-        Ignores case
-        Multiline
+def load_rules(regex_path: Path, kind: str) -> list[tuple[re.Pattern, str, Optional[str]]]:
+    """
+    Opens the regex_path, translates the regexes into pythonic regexes (ignoring case,
+    multiline), and returns them compiled, with the kind and the required literal of each
+    regex alongside it, as expected by Matcher
     """
     try:
         with Path(regex_path).open(encoding="utf8") as regex_file:
-            regexes = [re.compile(expression_to_regex(expr), re.IGNORECASE|re.MULTILINE) for expr in regex_file]
+            expressions = list(regex_file)
     except:
         raise FileNotFoundError
-    return regexes
+    return [(re.compile(expression_to_regex(expr), re.IGNORECASE|re.MULTILINE), kind, required_literal(expr)) for expr in expressions]
+
+
+RULE_CACHE_VERSION = 1  # bump when expression_to_regex, required_literal or Matcher change
+
+_matcher = None  # per worker process, set by init_worker
+
+
+def build_rule_cache(rule_paths: list[tuple[Path, str]], cache_dir: Path) -> Path:
+    """
+    Returns the path of the pickled Matcher for the given (regex_path, kind) list, translating and
+    building it only if there is no cache file yet for this exact content of the regex lists.
+
+    The cache file is named after a sha256 of the regex lists (and their kinds), so editing
+    any list gives a new cache file instead of a stale one.
+
+    NOTE:
+        pickled re.Patterns are recompiled when loaded, the cache saves the translation,
+        literal extraction and prefilter construction
+    """
+    cache_dir = Path(cache_dir)
+    digest = hashlib.sha256(f"v{RULE_CACHE_VERSION}".encode())
+    for regex_path, kind in rule_paths:
+        digest.update(kind.encode() + b"\0" + Path(regex_path).read_bytes() + b"\0")
+    cache_path = cache_dir / f"rules-{digest.hexdigest()[:16]}.pkl"
+
+    if not cache_path.exists():
+        rules = []
+        for regex_path, kind in rule_paths:
+            rules += load_rules(regex_path, kind)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(Matcher(rules), cache_file)
+        os.replace(tmp_path, cache_path)
+
+    return cache_path
+
+
+def load_rule_cache(cache_path: Path) -> Matcher:
+    with open(cache_path, "rb") as cache_file:
+        return pickle.load(cache_file)
+
+
+def init_worker(cache_path: Path) -> None:
+    """
+    Pool initializer, loads the rules once per process rather than shipping them with every task
+    """
+    global _matcher
+    _matcher = load_rule_cache(cache_path)
+
+
+def annotate_worker(file_paths: list[Path]) -> tuple[list[str], Counter, int]:
+    """
+    Annotates a chunk of files, returns their names, the combined match counts and the bytes read
+    """
+    match_count = Counter()
+    n_bytes = 0
+    for file_path in file_paths:
+        match_count += annotate(file_path, _matcher)
+        n_bytes += file_path.stat().st_size
+    return [file_path.name for file_path in file_paths], match_count, n_bytes
+
+
+def chunk_work(dir_path: Path, done: set[str], chunk_bytes: int, max_chunk: int = 1000) -> Iterator[list[Path]]:
+    """
+    Streams the .txt files of dir_path that aren't in done, grouped into chunks of about
+    chunk_bytes, so many small notes travel together and big notes go on their own
+    """
+    chunk = []
+    size = 0
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".txt") or entry.name in done:
+                continue
+            chunk.append(Path(entry.path))
+            size += entry.stat().st_size
+            if size >= chunk_bytes or len(chunk) >= max_chunk:
+                yield chunk
+                chunk = []
+                size = 0
+    if chunk:
+        yield chunk
 
 
 @click.command()
@@ -163,11 +367,19 @@ def compile_regex_path(regex_path: Path) -> list[re.Pattern]:
 @click.argument('symptom_regex_path', type=click.Path(exists=True), required=False)
 @click.argument('event_regex_path', type=click.Path(exists=True), required=False)
 @click.argument('substance_regex_path', type=click.Path(exists=True), required=False)
-def main(dir_path: Path, symptom_regex_path: Path, event_regex_path: Path, substance_regex_path: Path) -> None:
+@click.option('--cache_dir', type=click.Path(), default=str(Path.home() / ".cache" / "preannotation"), help="where translated rule sets are cached")
+@click.option('--chunk_mb', type=float, default=4, help="approximate size of the notes sent to a worker at once")
+@click.option('--processes', type=int, default=None, help="number of workers, defaults to the number of CPUs")
+@click.option('--fresh', is_flag=True, help="ignore the manifest of a previous run and annotate everything again")
+def main(dir_path: Path, symptom_regex_path: Path, event_regex_path: Path, substance_regex_path: Path,
+         cache_dir: Path, chunk_mb: float, processes: Optional[int], fresh: bool) -> None:
     """
     dir_path: path to directory full of .txt files to annotate
     regex_file_path: path to .txt file, with 1 regular expression per line
         ex: preanno_symptoms_list.txt
+
+    Finished files are recorded in a manifest in dir_path (one per rule set), so an interrupted
+    run picks up where it stopped when started again with the same regex lists.
     """
 
     dir_path = Path(dir_path)
@@ -175,23 +387,56 @@ def main(dir_path: Path, symptom_regex_path: Path, event_regex_path: Path, subst
     event_regex_path = Path(event_regex_path)
     substance_regex_path = Path(substance_regex_path)
 
-    # ive never heard of itertools.ziplongest so no need to make me feel bad
-    symptom_regexes = [(regex,"Symptom") for regex in compile_regex_path(symptom_regex_path)]
-    event_regexes = [(regex,"Event") for regex in compile_regex_path(event_regex_path)]
-    substance_regexes = [(regex,"Substance") for regex in compile_regex_path(substance_regex_path)]
-    regexes = symptom_regexes + event_regexes + substance_regexes
+    cache_path = build_rule_cache([(symptom_regex_path, "Symptom"), (event_regex_path, "Event"), (substance_regex_path, "Substance")], cache_dir)
+
+    manifest_path = dir_path / f".preannotation-{cache_path.stem}.done"
+    if fresh and manifest_path.exists():
+        manifest_path.unlink()
+    done = set()
+    if manifest_path.exists():
+        with open(manifest_path, encoding="utf8") as manifest:
+            done = {line.rstrip("\n") for line in manifest}
+
+    processes = processes or os.cpu_count()
+    pending = threading.Semaphore(processes * 4)  # keeps the walk from running ahead of the workers
+    stopped = threading.Event()
 
     def work_generator():
-        for file_path in Path(dir_path).iterdir():
-            if not file_path.name.endswith(".txt"):
-                continue
+        for chunk in chunk_work(dir_path, done, int(chunk_mb * 2**20)):
+            pending.acquire()
+            if stopped.is_set():
+                return
+            yield chunk
 
-            yield file_path, regexes
+    match_count = Counter()
+    n_docs = 0
+    n_bytes = 0
+    start = time.perf_counter()
+
+    with Pool(processes, initializer=init_worker, initargs=(cache_path,)) as pool, \
+            open(manifest_path, "a", encoding="utf8") as manifest, \
+            tqdm(desc="Annotating", unit="doc", initial=len(done)) as progress:
+        try:
+            for names, counts, chunk_bytes in pool.imap_unordered(annotate_worker, work_generator()):
+                pending.release()
+                manifest.write("".join(name + "\n" for name in names))
+                manifest.flush()
+
+                match_count += counts
+                n_docs += len(names)
+                n_bytes += chunk_bytes
+                elapsed = time.perf_counter() - start
+                progress.update(len(names))
+                progress.set_postfix({"MB/s": f"{n_bytes / 2**20 / elapsed:.2f}"})
+        finally:
+            stopped.set()
+            pending.release(processes * 4)  # unblock the walk so the pool can shut down
+
+    elapsed = time.perf_counter() - start
+    print(f"annotated {n_docs} docs ({n_bytes / 2**20:.1f} MB) in {elapsed:.1f}s: "
+          f"{n_docs / elapsed:.1f} docs/s, {n_bytes / 2**20 / elapsed:.2f} MB/s, {len(done)} skipped from earlier runs")
+    pprint(match_count)
 
-    Pool().starmap(annotate, work_generator(), chunksize=100)
-    
 
 if __name__ == '__main__':
     main()
-
-